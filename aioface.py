@@ -0,0 +1,395 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Asyncio engine of Azure face API calls.
+#
+# The functions here mirror azface_detect(), azface_similar() and
+# azface_add() in utils, but run on a single event loop over a shared pool
+# of keep-alive HTTP connections instead of a thread per request, e.g.
+#
+#   async with AsyncFaceClient(endpoint, subscription_key) as client:
+#       faces = await azface_detect_async(client, 'photo.jpg')
+
+import asyncio
+import collections
+import hashlib
+import sys
+import urllib.request
+
+import aiohttp
+
+from mlhub.pkg import is_url
+
+from utils import (
+    MAX_SIMILAR_CANDIDATES,
+    PROFILER,
+    match_similar,
+    scale_faces,
+    shrink_image,
+)
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+CONCURRENCY = 100  # Default max number of requests in flight
+KEEPALIVE = 60  # Seconds to keep idle connections open for reuse
+TIMEOUT = 60  # Seconds before a request is abandoned
+
+
+# ----------------------------------------------------------------------
+# Client
+# ----------------------------------------------------------------------
+
+class FaceAPIError(Exception):
+    """Error response of Azure face API, with its HTTP <status_code> and <headers>."""
+
+    def __init__(self, status_code, message, headers=None):
+        super().__init__("{} {}".format(status_code, message))
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or {}
+
+
+class AsyncFaceClient:
+    """Asyncio client of the Azure face API REST interface.
+
+    All requests share one pool of keep-alive connections and at most
+    <concurrency> requests are in flight at a time, however many tasks use
+    the client.  If a RetryPolicy <policy> is given, requests are rate
+    limited and retried by it.  The client can be kept for the lifetime of
+    a service, and should be closed by close() or by using it as an async
+    context manager.
+    """
+
+    def __init__(self, endpoint, subscription_key, concurrency=CONCURRENCY, timeout=TIMEOUT, policy=None):
+        endpoint = '/'.join(endpoint.split('/')[:3])  # Remove any trailing path
+        self.base_url = endpoint + '/face/v1.0/'
+        self.concurrency = concurrency
+        self.policy = policy
+        self._headers = {'Ocp-Apim-Subscription-Key': subscription_key}
+        self._timeout = timeout
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+
+        # Created lazily so that the session is bound to the running event loop
+
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=KEEPALIVE)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._headers,
+                timeout=aiohttp.ClientTimeout(total=self._timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def request(self, method, path, params=None, json=None, data=None):
+        """Send a request to <path> of the face API and return its decoded JSON body, if any."""
+
+        if self.policy is not None:
+            return await self.policy.call_async(self._request, method, path, params, json, data)
+        return await self._request(method, path, params, json, data)
+
+    async def _request(self, method, path, params, json, data):
+        session = self._get_session()
+        headers = {'Content-Type': 'application/octet-stream'} if data is not None else None
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+
+        async with self._semaphore:
+            try:
+                async with session.request(
+                        method, self.base_url + path, params=params, json=json, data=data, headers=headers) as response:
+                    if response.status >= 400:
+                        raise FaceAPIError(response.status, await response.text(), dict(response.headers))
+                    if response.status == 204 or response.content_length == 0:
+                        return None
+                    return await response.json()
+            except aiohttp.ClientConnectionError as e:  # Retried by RetryPolicy like other connection errors
+                raise ConnectionError(str(e)) from e
+
+    # Face
+
+    async def detect(self, image, **kwargs):
+        """Detect faces in <image>, which is either a URL or the encoded image bytes."""
+
+        from azure.cognitiveservices.vision.face.models import DetectedFace
+
+        attrs = kwargs.get('return_face_attributes')
+        params = {
+            'returnFaceId': _flag(kwargs.get('return_face_id', True)),
+            'returnFaceLandmarks': _flag(kwargs.get('return_face_landmarks', False)),
+            'returnFaceAttributes': ','.join(str(getattr(x, 'value', x)) for x in attrs) if attrs else None,
+            'recognitionModel': kwargs.get('recognition_model'),
+            'returnRecognitionModel': _flag(kwargs.get('return_recognition_model')),
+            'detectionModel': kwargs.get('detection_model'),
+        }
+
+        if isinstance(image, str):
+            faces = await self.request('POST', 'detect', params=params, json={'url': image})
+        else:
+            faces = await self.request('POST', 'detect', params=params, data=image)
+
+        return [DetectedFace.deserialize(face) for face in faces]
+
+    async def find_similar(
+            self,
+            face_id,
+            face_list_id=None,
+            large_face_list_id=None,
+            face_ids=None,
+            max_num_of_candidates_returned=20,
+            mode='matchPerson'):
+        from azure.cognitiveservices.vision.face.models import SimilarFace
+
+        body = {
+            'faceId': face_id,
+            'faceListId': face_list_id,
+            'largeFaceListId': large_face_list_id,
+            'faceIds': face_ids,
+            'maxNumOfCandidatesReturned': max_num_of_candidates_returned,
+            'mode': mode,
+        }
+        body = {k: v for k, v in body.items() if v is not None}
+        faces = await self.request('POST', 'findsimilars', json=body)
+        return [SimilarFace.deserialize(face) for face in faces]
+
+    # Person group
+
+    async def list_person_groups(self):
+        from azure.cognitiveservices.vision.face.models import PersonGroup
+
+        return [PersonGroup.deserialize(x) for x in await self.request('GET', 'persongroups')]
+
+    async def create_person_group(self, person_group_id, name):
+        await self.request('PUT', 'persongroups/' + person_group_id, json={'name': name})
+
+    async def list_persons(self, person_group_id):
+        from azure.cognitiveservices.vision.face.models import Person
+
+        persons = await self.request('GET', 'persongroups/{}/persons'.format(person_group_id))
+        return [Person.deserialize(x) for x in persons]
+
+    async def create_person(self, person_group_id, name):
+        from azure.cognitiveservices.vision.face.models import Person
+
+        person = await self.request('POST', 'persongroups/{}/persons'.format(person_group_id), json={'name': name})
+        return Person.deserialize(person)
+
+    async def add_person_face(self, person_group_id, person_id, image):
+        """Add the face in <image>, either a URL or the encoded image bytes, to a person."""
+
+        from azure.cognitiveservices.vision.face.models import PersistedFace
+
+        path = 'persongroups/{}/persons/{}/persistedfaces'.format(person_group_id, person_id)
+        if isinstance(image, str):
+            face = await self.request('POST', path, json={'url': image})
+        else:
+            face = await self.request('POST', path, data=image)
+        return PersistedFace.deserialize(face)
+
+
+def _flag(value):
+    return None if value is None else str(bool(value)).lower()
+
+
+# ----------------------------------------------------------------------
+# Face
+# ----------------------------------------------------------------------
+
+async def read_file_async(path):
+    """Read the file <path> in the default executor, so the event loop is not blocked."""
+
+    def read():
+        with PROFILER.stage('read'), open(path, 'rb') as file:
+            return file.read()
+
+    return await asyncio.get_event_loop().run_in_executor(None, read)
+
+
+def read_url(url):
+    with PROFILER.stage('read'), urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def hash_data(data):
+    with PROFILER.stage('hash'):
+        return hashlib.md5(data).hexdigest()
+
+
+def get_cached(cache, key):
+    with PROFILER.stage('cache'):
+        return cache.get(key)
+
+
+def put_cached(cache, key, faces):
+    with PROFILER.stage('cache'):
+        cache.put(key, faces)
+
+
+async def has_face_async(prefilter, data):
+    """Screen the encoded image <data> by the FacePrefilter <prefilter> in the default executor."""
+
+    return await asyncio.get_event_loop().run_in_executor(None, prefilter.has_face, data)
+
+
+async def azface_detect_async(
+        client, img_url, cache=None, prefilter=None, max_side=None, max_bytes=None, manifest=None, **kwargs):
+    """Detect faces like azface_detect() but with the AsyncFaceClient <client>."""
+
+    if is_url(img_url) and prefilter is None and not (max_side or max_bytes):
+        with PROFILER.stage('detect'):
+            return await client.detect(img_url, **kwargs)
+
+    if is_url(img_url):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, read_url, img_url)
+        cache = manifest = None  # Photos at URLs may change, nor are they recorded
+    else:
+        data = await read_file_async(img_url)
+
+    loop = asyncio.get_event_loop()
+    digest = None
+    if cache is not None or manifest is not None:
+        digest = await loop.run_in_executor(None, hash_data, data)
+
+    if cache is not None:
+        key = cache.make_key(digest, max_side=max_side, max_bytes=max_bytes, **kwargs)
+        faces = await loop.run_in_executor(None, get_cached, cache, key)
+        if faces is None:
+            if prefilter is not None and not await has_face_async(prefilter, data):
+                faces = []  # Not cached, as in azface_detect_data()
+            else:
+                faces = await azface_detect_data_async(
+                    client, data, max_side=max_side, max_bytes=max_bytes, **kwargs)
+                await loop.run_in_executor(None, put_cached, cache, key, faces)
+    else:
+        faces = await azface_detect_data_async(
+            client, data, prefilter=prefilter, max_side=max_side, max_bytes=max_bytes, **kwargs)
+
+    if manifest is not None:
+        await loop.run_in_executor(None, manifest.add, img_url, digest)
+    return faces
+
+
+async def azface_detect_data_async(client, data, prefilter=None, max_side=None, max_bytes=None, **kwargs):
+    """Detect faces in the encoded image <data> like azface_detect_data() but with the AsyncFaceClient <client>."""
+
+    if prefilter is not None and not await has_face_async(prefilter, data):
+        return []
+
+    scale = 1.0
+    if max_side or max_bytes:
+        loop = asyncio.get_event_loop()
+        with PROFILER.stage('shrink'):
+            data, scale = await loop.run_in_executor(None, shrink_image, data, max_side, max_bytes)
+
+    with PROFILER.stage('detect'):
+        faces = await client.detect(data, **kwargs)
+    return scale_faces(faces, 1 / scale) if scale != 1.0 else faces
+
+
+async def azface_detect_many_async(client, img_urls, **kwargs):
+    """Detect faces in each of <img_urls> like azface_detect_many() but with the AsyncFaceClient <client>.
+
+    This is an async generator of (img_url, faces) in the order of <img_urls>.
+    The client bounds the requests in flight, and only a bounded number of
+    photos are queued ahead of the output, so <img_urls> can be endless.
+    <img_urls> is iterated in the default executor, since it may read stdin
+    or check a manifest, which would hold up the requests in flight.
+    """
+
+    async def detect(img_url):
+        try:
+            return await azface_detect_async(client, img_url, **kwargs)
+        except Exception as e:
+            print("Failed to detect faces in {}: {}".format(img_url, e), file=sys.stderr)
+            return None
+
+    loop = asyncio.get_event_loop()
+    img_urls = iter(img_urls)
+    pending = collections.deque()
+    while True:
+        img_url = await loop.run_in_executor(None, next, img_urls, None)
+        if img_url is None:
+            break
+        pending.append((img_url, asyncio.ensure_future(detect(img_url))))
+        if len(pending) >= 2 * client.concurrency:
+            img_url, task = pending.popleft()
+            yield img_url, await task
+
+    while pending:
+        img_url, task = pending.popleft()
+        yield img_url, await task
+
+
+async def azface_similar_async(client, target_faces, candidate_faces, threshold=None):
+    """Match faces like azface_similar() but with the AsyncFaceClient <client>.
+
+    Each find_similar call is made against at most MAX_SIMILAR_CANDIDATES
+    candidate faces, as in azface_find_similar().
+    """
+
+    matches = {}
+    if candidate_faces:
+        candidate_ids = [x.face_id for x in candidate_faces]
+        chunks = [candidate_ids[i:i + MAX_SIMILAR_CANDIDATES]
+                  for i in range(0, len(candidate_ids), MAX_SIMILAR_CANDIDATES)]
+        calls = [(face.face_id, ids) for face in target_faces for ids in chunks]
+        results = await asyncio.gather(*[
+            client.find_similar(face_id, face_ids=ids, max_num_of_candidates_returned=len(ids))
+            for face_id, ids in calls])
+        similar = {face.face_id: [] for face in target_faces}
+        for (face_id, _), result in zip(calls, results):
+            similar[face_id].extend(result)
+        matches = match_similar(target_faces, candidate_faces, similar, threshold=threshold)
+
+    return matches
+
+
+async def azface_add_async(client, img_url, name, person=None):
+    """Add the face in img_url to the person name like azface_add() but with the AsyncFaceClient <client>."""
+
+    # Use the person name as person group ID and person group name
+
+    person_group_id = name
+    person_group_name = name
+    person_name = name
+
+    if not person:  # Get the person information.  Create it if not available
+        person_groups = [x.person_group_id for x in await client.list_person_groups()]
+        if person_group_id not in person_groups:
+            await client.create_person_group(person_group_id, person_group_name)
+
+        person_list = await client.list_persons(person_group_id)
+        try:
+            person = next(x for x in person_list if x.name == person_name)
+        except StopIteration:
+            person = await client.create_person(person_group_id, person_name)
+
+    image = img_url if is_url(img_url) else await read_file_async(img_url)
+    await client.add_person_face(person_group_id, person.person_id, image)
+
+    return person
+
+
+def run(coro):
+    """Run the coroutine <coro> to completion on a new event loop, as from the command line."""
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
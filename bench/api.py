@@ -0,0 +1,171 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Measure the throughput and latency of the azface flows against a local fake
+# of Azure face API, so that performance changes can be compared offline.
+#
+# Each flow runs the same functions as its command over the bundled photos in
+# docs/photo, --rounds times, against a FakeFaceAPI with the given latency and
+# injected errors.  The throughput in photos per second of each flow is
+# reported, then the p50, p95 and p99 latencies of each operation as seen by
+# the client, retries included, and the calls received by the server.
+#
+#   $ python3 bench/api.py --flows detect similar --rounds 5 --latency 0.1 --throttle-rate 0.02
+
+import argparse
+import collections
+import math
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakeapi import FakeFaceAPI  # noqa: E402
+from utils import (  # noqa: E402
+    DETECT_WORKERS,
+    RETRIES,
+    STATS,
+    FaceIndex,
+    PersonGroup,
+    RetryPolicy,
+    ThrottledClient,
+    azface_enroll,
+    azface_index,
+    detect_photos,
+    expand_paths,
+    list_people,
+    similar_photos,
+)
+
+PHOTOS = os.path.join(ROOT, 'docs', 'photo')
+
+FLOWS = ['detect', 'similar', 'enroll', 'index']
+
+
+class TimedPolicy(RetryPolicy):
+    """RetryPolicy recording the seconds taken by each call, retries included, by operation name."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().call(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.latencies[func.__name__].append(time.perf_counter() - start)
+
+
+def get_client(endpoint, policy):
+    """Return a FaceClient of <endpoint> calling every operation per the RetryPolicy <policy>."""
+
+    from azure.cognitiveservices.vision.face import FaceClient
+    from msrest.authentication import CognitiveServicesCredentials
+
+    return ThrottledClient(FaceClient(endpoint, CognitiveServicesCredentials('fake')), policy)
+
+
+def percentile(values, q):
+    """Return the <q>th percentile of <values> by the nearest rank method."""
+
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def run_flow(flow, client, run, workers):
+    """Run the <flow> once as its command would, as the <run>th run, and return the number of photos processed."""
+
+    with open(os.devnull, 'w') as devnull:
+        if flow == 'detect':
+            photos = list(expand_paths([PHOTOS], -1))
+            detect_photos(
+                client,
+                photos,
+                tagged=True,
+                workers=workers,
+                file=devnull,
+                return_face_id=False,
+                return_face_attributes=['age', 'gender', 'glasses', 'emotion', 'occlusion'])
+            return len(photos)
+
+        if flow == 'similar':
+            targets = list(expand_paths([os.path.join(PHOTOS, 'identification')], 0))
+            candidates = list(expand_paths([os.path.join(PHOTOS, 'PersonGroup')], -1))
+            similar_photos(client, targets, candidates, tagged=True, workers=workers, file=devnull)
+            return len(targets) + len(candidates)
+
+        if flow == 'enroll':
+            group = PersonGroup(client, 'bench{}'.format(run))
+            return len(list(azface_enroll(group, list_people(os.path.join(PHOTOS, 'PersonGroup')), workers=workers)))
+
+        if flow == 'index':
+            index = FaceIndex(':memory:', 'bench{}'.format(run))
+            photos = list(expand_paths([PHOTOS], -1))
+            list(azface_index(client, photos, index, workers=workers))
+            return len(photos)
+
+
+def report(flow, photos, seconds, policy, calls):
+    print("{}: {} photos in {:.2f}s, {:.1f} photos/s".format(flow, photos, seconds, photos / seconds))
+
+    print("  {:<28} {:>6} {:>8} {:>8} {:>8}".format('operation', 'calls', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, latencies in sorted(policy.latencies.items()):
+        print("  {:<28} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+            name, len(latencies), *(1000 * percentile(latencies, q) for q in (50, 95, 99))))
+
+    print("  {:<48} {:>6} {:>6}".format('endpoint', 'status', 'calls'))
+    for (label, status), n in sorted(calls.items()):
+        print("  {:<48} {:>6} {:>6}".format(label, status, n))
+
+    for name, n in sorted(STATS.counts.items()):
+        print("  {}: {}".format(name, n))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the azface flows against a local fake of Azure face API.')
+    parser.add_argument('--flows', nargs='+', choices=FLOWS, default=FLOWS, help='flows to measure (default: all)')
+    parser.add_argument('--rounds', type=int, default=3, help='runs of each flow over the bundled photos')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds taken by each call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max seconds of latency added or removed at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with a 500 error')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of calls throttled with a 429 error')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds of Retry-After of throttled calls')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='max retries of each call')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the injected latencies and errors')
+    parser.add_argument('-j', '--workers', type=int, default=DETECT_WORKERS, help='concurrent requests')
+    args = parser.parse_args()
+
+    with FakeFaceAPI(
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after=args.retry_after,
+            seed=args.seed) as api:
+
+        for flow in args.flows:
+            policy = TimedPolicy(retries=args.retries)
+            client = get_client(api.endpoint, policy)
+            api.calls.clear()
+            STATS.counts.clear()
+
+            photos = 0
+            start = time.perf_counter()
+            for run in range(args.rounds):
+                photos += run_flow(flow, client, run, args.workers)
+            seconds = time.perf_counter() - start
+
+            report(flow, photos, seconds, policy, api.calls)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,421 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Local stand-in for Azure face API, to measure the azface commands offline.
+#
+# The server answers the detect, findsimilars and identify calls, and those
+# of face lists, large face lists, person groups and large person groups,
+# well enough for the azface commands to run against it.  Faces are made up
+# from the md5 digest of each photo, so that the same photo always has the
+# same faces.  Every call can be delayed by --latency seconds, give or take
+# --jitter, and fail with a 500 error or be throttled with a 429 error at the
+# given rates, to exercise the retries of the client.
+#
+#   $ python3 bench/fakeapi.py --port 8000 --latency 0.2 --throttle-rate 0.05 &
+#   $ ml detect azface --key fake --endpoint http://127.0.0.1:8000 ~/Pictures
+
+import argparse
+import collections
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+BASE_PATH = '/face/v1.0/'
+
+# Kinds of face collections, and the JSON key of their IDs
+
+GROUP_KINDS = {
+    'facelists': 'faceListId',
+    'largefacelists': 'largeFaceListId',
+    'persongroups': 'personGroupId',
+    'largepersongroups': 'largePersonGroupId',
+}
+
+MAX_FACES = 3  # Max number of faces made up for a photo
+
+
+class APIError(Exception):
+    """Error response of the fake service, with its HTTP <status> and error <code>."""
+
+    def __init__(self, status, code, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+
+
+# ----------------------------------------------------------------------
+# Service
+# ----------------------------------------------------------------------
+
+def get_score(*ids):
+    """Return a made up but stable score from 0 to 1 of <ids>, such as the confidence of two faces matching."""
+
+    digest = hashlib.md5('/'.join(ids).encode()).hexdigest()
+    return int(digest[:8], 16) / 0xffffffff
+
+
+def make_faces(digest, return_face_id=True, attributes=()):
+    """Return the JSON of the faces made up for the photo of <digest>, with the given face <attributes>."""
+
+    faces = []
+    for i in range(int(digest[:2], 16) % MAX_FACES + 1):
+        face = {'faceRectangle': {'left': 10 + 60 * i, 'top': 20, 'width': 50, 'height': 50}}
+        if return_face_id:
+            face['faceId'] = str(uuid.uuid4())
+        values = {
+            'age': 20.0 + int(digest[2 + i], 16) * 3,
+            'gender': 'female' if int(digest[8 + i], 16) % 2 else 'male',
+            'glasses': 'NoGlasses',
+            'emotion': {'happiness': 0.9, 'neutral': 0.1},
+            'occlusion': {'foreheadOccluded': False, 'eyeOccluded': False, 'mouthOccluded': False},
+        }
+        if attributes:
+            face['faceAttributes'] = {name: values[name] for name in attributes if name in values}
+        faces.append(face)
+
+    return faces
+
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class FakeFaceService:
+    """State and calls of the fake face API.
+
+    Trainings take <train_seconds> to succeed.  All calls are thread safe.
+    """
+
+    def __init__(self, train_seconds=0.0):
+        self.train_seconds = train_seconds
+        self._lock = threading.Lock()
+        self._groups = {kind: {} for kind in GROUP_KINDS}
+
+    def call(self, method, parts, query, body):
+        """Serve the call <method> of the path <parts> under BASE_PATH and return its (status, JSON response).
+
+        <body> is the decoded JSON of the request, or the bytes of a photo.
+        """
+
+        if parts == ['detect'] and method == 'POST':
+            return 200, self.detect(query, body)
+        if parts == ['findsimilars'] and method == 'POST':
+            return 200, self.find_similar(body)
+        if parts == ['identify'] and method == 'POST':
+            return 200, self.identify(body)
+
+        if not parts or parts[0] not in GROUP_KINDS:
+            raise APIError(404, 'NotFound', 'Resource not found')
+        kind = parts[0]
+        payload = body if isinstance(body, dict) else {}
+
+        with self._lock:
+            if len(parts) == 1 and method == 'GET':
+                groups = self._groups[kind].items()
+                return 200, [self.get_group_json(kind, group_id, group) for group_id, group in groups]
+
+            group_id = parts[1]
+            if len(parts) == 2 and method == 'PUT':
+                if group_id in self._groups[kind]:
+                    raise APIError(409, 'PersonGroupExists', 'The group already exists.')
+                self._groups[kind][group_id] = {
+                    'name': payload.get('name', group_id), 'persons': {}, 'faces': [], 'trained': None}
+                return 200, None
+
+            group = self._groups[kind].get(group_id)
+            if group is None:
+                raise APIError(404, 'NotFound', 'Group {} is not found.'.format(group_id))
+
+            if len(parts) == 2 and method == 'GET':
+                return 200, self.get_group_json(kind, group_id, group)
+            if len(parts) == 2 and method == 'DELETE':
+                del self._groups[kind][group_id]
+                return 200, None
+            if parts[2:] == ['train'] and method == 'POST':
+                group['trained'] = time.time()
+                return 202, None
+            if parts[2:] == ['training'] and method == 'GET':
+                return 200, self.get_training_json(group)
+            if parts[2:] == ['persistedfaces'] and method == 'POST' and not kind.endswith('persongroups'):
+                face_id = str(uuid.uuid4())
+                group['faces'].append(face_id)
+                return 200, {'persistedFaceId': face_id}
+
+            if kind.endswith('persongroups') and len(parts) >= 3 and parts[2] == 'persons':
+                return self.call_persons(group, method, parts[3:], query, payload)
+
+        raise APIError(404, 'NotFound', 'Resource not found')
+
+    def call_persons(self, group, method, parts, query, payload):
+        persons = group['persons']
+
+        if not parts and method == 'POST':
+            person_id = str(uuid.uuid4())
+            persons[person_id] = {'personId': person_id, 'name': payload.get('name'), 'persistedFaceIds': []}
+            return 200, {'personId': person_id}
+        if not parts and method == 'GET':
+            start = query.get('start')
+            top = int(query.get('top', 1000))
+            listed = sorted(person_id for person_id in persons if start is None or person_id > start)[:top]
+            return 200, [persons[person_id] for person_id in listed]
+
+        person = persons.get(parts[0])
+        if person is None:
+            raise APIError(404, 'PersonNotFound', 'Person {} is not found.'.format(parts[0]))
+        if len(parts) == 1 and method == 'GET':
+            return 200, person
+        if parts[1:] == ['persistedfaces'] and method == 'POST':
+            face_id = str(uuid.uuid4())
+            person['persistedFaceIds'].append(face_id)
+            return 200, {'persistedFaceId': face_id}
+
+        raise APIError(404, 'NotFound', 'Resource not found')
+
+    @staticmethod
+    def get_group_json(kind, group_id, group):
+        return {GROUP_KINDS[kind]: group_id, 'name': group['name'], 'userData': None}
+
+    def get_training_json(self, group):
+        if group['trained'] is None:
+            raise APIError(404, 'PersonGroupNotTrained', 'Group not trained.')
+        running = time.time() < group['trained'] + self.train_seconds
+        return {
+            'status': 'running' if running else 'succeeded',
+            'createdDateTime': now(),
+            'lastActionDateTime': now(),
+            'message': None,
+        }
+
+    def detect(self, query, body):
+        digest = hashlib.md5(body if isinstance(body, bytes) else body['url'].encode()).hexdigest()
+
+        attributes = [x for x in query.get('returnFaceAttributes', '').split(',') if x]
+        return make_faces(digest, return_face_id=query.get('returnFaceId', 'true') == 'true', attributes=attributes)
+
+    def find_similar(self, request):
+        face_id = request['faceId']
+        top = request.get('maxNumOfCandidatesReturned', 20)
+
+        if request.get('faceIds'):
+            key, candidates = 'faceId', request['faceIds']
+        else:
+            if request.get('largeFaceListId'):
+                kind, group_id = 'largefacelists', request['largeFaceListId']
+            else:
+                kind, group_id = 'facelists', request.get('faceListId')
+            with self._lock:
+                group = self._groups[kind].get(group_id)
+                if group is None:
+                    raise APIError(404, 'FaceListNotFound', 'Face list {} is not found.'.format(group_id))
+                if kind == 'largefacelists' and group['trained'] is None:
+                    raise APIError(409, 'LargeFaceListNotTrained', 'Large face list is not trained.')
+                key, candidates = 'persistedFaceId', list(group['faces'])
+
+        similar = [{key: candidate, 'confidence': get_score(face_id, candidate)} for candidate in candidates]
+        similar = sorted((x for x in similar if x['confidence'] >= 0.5), key=lambda x: -x['confidence'])
+        return similar[:top]
+
+    def identify(self, request):
+        if request.get('largePersonGroupId'):
+            kind, group_id = 'largepersongroups', request['largePersonGroupId']
+        else:
+            kind, group_id = 'persongroups', request.get('personGroupId')
+        top = request.get('maxNumOfCandidatesReturned', 1)
+        threshold = request.get('confidenceThreshold') or 0.5
+
+        if len(request['faceIds']) > 10:
+            raise APIError(400, 'BadArgument', 'Too many face IDs, at most 10 are allowed.')
+
+        with self._lock:
+            group = self._groups[kind].get(group_id)
+            if group is None:
+                raise APIError(404, 'PersonGroupNotFound', 'Group {} is not found.'.format(group_id))
+            if group['trained'] is None:
+                raise APIError(409, 'PersonGroupNotTrained', 'Group {} is not trained.'.format(group_id))
+            person_ids = list(group['persons'])
+
+        results = []
+        for face_id in request['faceIds']:
+            candidates = [{'personId': x, 'confidence': get_score(face_id, x)} for x in person_ids]
+            candidates = sorted((x for x in candidates if x['confidence'] >= threshold), key=lambda x: -x['confidence'])
+            results.append({'faceId': face_id, 'candidates': candidates[:top]})
+        return results
+
+
+# ----------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------
+
+class FakeFaceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as the service
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_call(self):
+        api = self.server.api
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        parts = url.path[len(BASE_PATH):].strip('/').split('/') if url.path.startswith(BASE_PATH) else []
+        label = '{} {}'.format(self.command, '/'.join('*' if i in (1, 3) else x for i, x in enumerate(parts)))
+
+        api.delay()
+        headers = {}
+        try:
+            api.inject_error()
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                body = json.loads(body.decode()) if body else {}
+            status, response = api.service.call(self.command, parts, query, body)
+        except APIError as e:
+            status, response, headers = e.status, {'error': {'code': e.code, 'message': e.message}}, e.headers
+        except (KeyError, ValueError) as e:
+            status, response = 400, {'error': {'code': 'BadArgument', 'message': 'Invalid request: {}'.format(e)}}
+        api.count(label, status)
+
+        data = b'' if response is None else json.dumps(response).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = handle_call
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeFaceAPI:
+    """HTTP server of a FakeFaceService on <host>:<port>, any free port if <port> is 0.
+
+    Each call is delayed by <latency> seconds, give or take <jitter>, then
+    fails with a 500 error at <error_rate> or is throttled with a 429 error
+    and a Retry-After of <retry_after> seconds at <throttle_rate>.  Calls are
+    counted by endpoint and status in <calls>.  The server runs in a
+    background thread between start() and close(), or as a context manager.
+    """
+
+    def __init__(
+            self,
+            host='127.0.0.1',
+            port=0,
+            latency=0.0,
+            jitter=0.0,
+            error_rate=0.0,
+            throttle_rate=0.0,
+            retry_after=1,
+            train_seconds=0.0,
+            seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.service = FakeFaceService(train_seconds)
+        self.calls = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), FakeFaceHandler)
+        self._server.api = self
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve in the calling thread until interrupted."""
+
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def delay(self):
+        with self._lock:
+            seconds = self._random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def inject_error(self):
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            raise APIError(
+                429, '429', 'Rate limit is exceeded. Try again later.', {'Retry-After': str(self.retry_after)})
+        if draw < self.throttle_rate + self.error_rate:
+            raise APIError(500, 'InternalServerError', 'Injected failure.')
+
+    def count(self, label, status):
+        with self._lock:
+            self.calls[label, status] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for Azure face API.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds taken by each call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max seconds of latency added or removed at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with a 500 error')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of calls throttled with a 429 error')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds of Retry-After of throttled calls')
+    parser.add_argument('--train-seconds', type=float, default=0.0, help='seconds taken by each training')
+    parser.add_argument('--seed', type=int, help='seed of the injected latencies and errors')
+    args = parser.parse_args()
+
+    api = FakeFaceAPI(
+        args.host,
+        args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        train_seconds=args.train_seconds,
+        seed=args.seed)
+    print("Serving fake Azure face API at {}".format(api.endpoint), file=sys.stderr)
+
+    api.serve_forever()
+    for (label, status), n in sorted(api.calls.items()):
+        print("{:<48} {:>4} {:>8}".format(label, status, n), file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
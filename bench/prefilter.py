@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Measure the calls saved and the faces missed by the local face prefilter.
+#
+# Each photo of a labelled sample is screened once by the prefilter, and the
+# photos it would skip are then counted for each of the given thresholds.  A
+# photo with faces that is skipped is a miss, and the miss rate is the share
+# of the photos with faces which are missed.  The labels are read from a CSV
+# file of path,number of faces lines, or else taken from Azure face API
+# itself, which costs one call per photo not yet in the detection cache.
+#
+#   $ python3 bench/prefilter.py --labels labels.csv --thresholds -1 0 1 2 4 ~/Pictures
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import (  # noqa: E402
+    DETECT_WORKERS,
+    FacePrefilter,
+    azface_detect_many,
+    expand_paths,
+    get_detection_cache,
+    get_face_client,
+    option_parser,
+)
+
+
+def read_labels(path):
+    """Return a dict from the path of each photo to its number of faces in the CSV file <path>."""
+
+    with open(path, newline='') as file:
+        return {row[0]: int(row[1]) for row in csv.reader(file) if row and not row[0].startswith('#')}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        parents=[option_parser],
+        description='Measure the calls saved and the faces missed by the local face prefilter.')
+    parser.add_argument('path', nargs='*', help='photos, folders or globs of the sample (default: those labelled)')
+    parser.add_argument('--labels', help='CSV file of path,number of faces (default: detect by Azure face API)')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[-1, 0, 1, 2, 4], help='thresholds to measure')
+    parser.add_argument('--depth', type=int, default=-1, help='level of photos in folders, -1 for all levels')
+    parser.add_argument('-j', '--workers', type=int, default=DETECT_WORKERS, help='concurrent requests')
+    args = parser.parse_args()
+
+    labels = read_labels(args.labels) if args.labels else {}
+    paths = list(expand_paths(args.path, args.depth)) if args.path else list(labels)
+
+    if not args.labels:
+        client = get_face_client(args)
+        cache = get_detection_cache(args)
+        for path, faces in azface_detect_many(
+                client, paths, workers=args.workers, cache=cache, return_face_id=False):
+            if faces is not None:
+                labels[path] = len(faces)
+
+    paths = [path for path in paths if path in labels]
+    if not paths:
+        print("No labelled photos!", file=sys.stderr)
+        return 1
+
+    # Screen each photo once, then compare its confidence with every threshold
+
+    prefilter = FacePrefilter()
+    confidences = {}
+    start = time.time()
+    for path in paths:
+        with open(path, 'rb') as file:
+            confidences[path] = prefilter.get_confidence(file.read())
+    seconds = time.time() - start
+
+    with_faces = [path for path in paths if labels[path]]
+    print("{} photos, {} with faces, {:.1f} ms per photo screened".format(
+        len(paths), len(with_faces), 1000 * seconds / len(paths)))
+    print("{:>10} {:>8} {:>7} {:>8} {:>7}".format('threshold', 'skipped', 'saved', 'missed', 'miss'))
+
+    for threshold in sorted(args.thresholds):
+        skipped = [path for path in paths if confidences[path] is None or confidences[path] < threshold]
+        missed = [path for path in skipped if labels[path]]
+        print("{:>10} {:>8} {:>6.1f}% {:>8} {:>6.1f}%".format(
+            threshold,
+            len(skipped),
+            100 * len(skipped) / len(paths),
+            len(missed),
+            100 * len(missed) / len(with_faces) if with_faces else 0.0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
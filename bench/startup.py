@@ -0,0 +1,80 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Measure the startup time of the azface commands and guard against regressions.
+#
+# Each command is run with --help, which exits right after all its top level
+# imports and the parsing of the command line, so its run time is the start
+# up cost paid by every invocation.  The run fails if a command imports any of
+# SLOW_MODULES at startup, beyond those already imported by mlhub itself, or
+# if it takes longer than --budget seconds on top of a bare Python start.
+#
+#   $ python3 bench/startup.py --runs 10 --budget 0.3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = ['detect.py', 'similar.py', 'index.py', 'daemon.py', 'stream.py', 'identify.py', 'enroll.py']
+
+# Modules only needed to display images or call the service
+
+SLOW_MODULES = ['aiohttp', 'azure', 'cv2', 'matplotlib', 'msrest', 'numpy', 'toolz']
+
+
+def run(args, runs):
+    """Run python with <args> <runs> times and return (median seconds, imported module names)."""
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    trace = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True).stderr
+    modules = {line.rsplit('|', 1)[-1].strip() for line in trace.splitlines() if line.startswith('import time:')}
+
+    return statistics.median(times), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of the azface commands.')
+    parser.add_argument('--runs', type=int, default=5, help='runs of each command (default: 5)')
+    parser.add_argument('--budget', type=float, help='max seconds of startup on top of a bare Python start')
+    args = parser.parse_args()
+
+    bare, _ = run(['-c', 'pass'], args.runs)
+    base, base_modules = run(['-c', 'import mlhub.pkg, mlhub.utils'], args.runs)
+    print("{:<12} {:>8}".format('python', '{:.3f}s'.format(bare)))
+    print("{:<12} {:>8}".format('mlhub', '{:.3f}s'.format(base)))
+
+    failures = []
+    for entry in ['utils'] + COMMANDS:
+        cmd = ['-c', 'import utils'] if entry == 'utils' else [entry, '--help']
+        seconds, modules = run(cmd, args.runs)
+        slow = sorted(m for m in SLOW_MODULES if m in modules - base_modules)
+        print("{:<12} {:>8}  {}".format(entry, '{:.3f}s'.format(seconds), ' '.join(slow)))
+
+        if slow:
+            failures.append("{} imports {} at startup".format(entry, ', '.join(slow)))
+        if args.budget is not None and seconds - bare > args.budget:
+            failures.append("{} takes {:.3f}s to start, over the budget of {}s".format(entry, seconds - bare, args.budget))
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
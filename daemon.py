@@ -0,0 +1,260 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Daemon serving the detect and similar commands with a warm client.
+#
+# The daemon keeps the Azure face API client, its pool of connections, the
+# rate limiter and the detection cache alive between commands, so that the
+# detect and similar commands only parse their arguments and forward them
+# to the daemon over a Unix socket.
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from utils import (
+    DETECTION_SCHEMA,
+    DuplicateIndex,
+    FaceIndex,
+    FacePrefilter,
+    Renderer,
+    SIMILAR_SCHEMA,
+    STATS,
+    Stats,
+    detect_photos,
+    get_detection_cache,
+    get_face_client,
+    get_result_writer,
+    option_parser,
+    similar_photos,
+    stop,
+)
+
+
+# ----------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------
+
+class DaemonWriter:
+    """File-like object sending what is written to the <stream> ('out' or 'err') of a daemon client.
+
+    Writers of the same client share the <lock>, since they are written by
+    the threads of the command.  Text is sent a whole line at a time, kept
+    apart per thread until its newline, so that print() calls of concurrent
+    threads do not interleave.
+    """
+
+    def __init__(self, wfile, stream, lock):
+        self._wfile = wfile
+        self._stream = stream
+        self._lock = lock
+        self._partial = {}  # Text after the last newline written by each thread
+
+    def write(self, text):
+        with self._lock:
+            thread = threading.get_ident()
+            pending = self._partial.pop(thread, '') + text
+            end = pending.rfind('\n') + 1
+            if end < len(pending):
+                self._partial[thread] = pending[end:]
+            if end:
+                self._send(pending[:end])
+        return len(text)
+
+    def flush(self):
+        self._wfile.flush()
+
+    def close(self):
+        """Send the text left without a newline by any thread."""
+
+        with self._lock:
+            for text in self._partial.values():
+                self._send(text)
+            self._partial = {}
+
+    def _send(self, text):
+        self._wfile.write(json.dumps({self._stream: text}).encode() + b'\n')
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Serve a command requested by call_daemon() with the commands of the daemon server."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if 'stream' in request:
+            request['params'][request['stream']] = self.read_stream()
+        lock = threading.Lock()
+        out = DaemonWriter(self.wfile, 'out', lock)
+        err = DaemonWriter(self.wfile, 'err', lock)
+        try:
+            status = self.server.commands[request['command']](request['params'], out, err)
+        except Exception as e:
+            print("{}: {}".format(type(e).__name__, e), file=err)
+            status = 1
+
+        out.close()
+        err.close()
+        self.wfile.write(json.dumps({'exit': status}).encode() + b'\n')
+
+    def read_stream(self):
+        """Yield the items streamed by the client until the null ending them."""
+
+        for line in self.rfile:
+            item = json.loads(line.decode())
+            if item is None:
+                return
+            yield item
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server of the daemon, serving each request in its own thread.
+
+    <commands> maps the name of each command to a function (params, out, err)
+    returning the exit status of the command.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, commands):
+        if os.path.exists(path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                    conn.connect(path)
+            except ConnectionRefusedError:  # Left by a daemon which did not shut down cleanly
+                os.remove(path)
+            else:
+                raise OSError("A daemon is already listening on {}".format(path))
+        super().__init__(path, DaemonHandler)
+        self.commands = commands
+
+
+# ----------------------------------------------------------------------
+# Parse command line arguments
+# ----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    prog='daemon',
+    parents=[option_parser],
+    description='Serve the detect and similar commands with a warm Azure face API client.'
+)
+
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------
+# Setup
+# ----------------------------------------------------------------------
+
+client = get_face_client(args)
+cache = get_detection_cache(args)
+
+
+# ----------------------------------------------------------------------
+# Commands
+# ----------------------------------------------------------------------
+
+def get_prefilter(params):
+    threshold = params.pop('prefilter')
+    return None if threshold is None else FacePrefilter(threshold)
+
+
+def get_dedup(params):
+    distance = params.pop('dedup')
+    return None if distance is None else DuplicateIndex(distance)
+
+
+def get_renderer(params, err):
+    folder, ext, workers = params.pop('render'), '.' + params.pop('render_format'), params.pop('render_workers')
+    return None if folder is None else Renderer(folder, workers, ext, err=err)
+
+
+def get_writer(params, schema, out):
+    return get_result_writer(params.pop('format'), schema, params.pop('output'), out)
+
+
+# Each command counts its own statistics, apart from those of the commands served before or at the same time
+
+def detect(params, out, err):
+    use_cache = not params.pop('no_cache')
+    report = params.pop('stats')
+    prefilter = get_prefilter(params)
+    dedup = get_dedup(params)
+    writer = get_writer(params, DETECTION_SCHEMA, out)
+    renderer = get_renderer(params, err)
+    with STATS.use(Stats()) as stats:
+        try:
+            failed = detect_photos(
+                client,
+                file=out,
+                cache=cache if use_cache else None,
+                prefilter=prefilter,
+                dedup=dedup,
+                renderer=renderer,
+                writer=writer,
+                err=err,
+                **params)
+        finally:
+            if writer is not None:
+                writer.close()
+            if renderer is not None:
+                renderer.close()
+    if report:
+        stats.report(file=err)
+    return 1 if failed else 0
+
+
+def similar(params, out, err):
+    use_cache = not params.pop('no_cache')
+    report = params.pop('stats')
+    face_list, index_file = params.pop('face_list'), params.pop('index_file')
+    index = FaceIndex(index_file, face_list) if face_list else None
+    prefilter = get_prefilter(params)
+    writer = get_writer(params, SIMILAR_SCHEMA, out)
+    renderer = get_renderer(params, err)
+    with STATS.use(Stats()) as stats:
+        try:
+            found = similar_photos(
+                client,
+                file=out,
+                cache=cache if use_cache else None,
+                prefilter=prefilter,
+                renderer=renderer,
+                writer=writer,
+                index=index,
+                err=err,
+                **params)
+        finally:
+            if index is not None:
+                index.close()
+            if writer is not None:
+                writer.close()
+            if renderer is not None:
+                renderer.close()
+    if not found:
+        print("No faces found!", file=err)
+    if report:
+        stats.report(file=err)
+    return 0
+
+
+# ----------------------------------------------------------------------
+# Serve commands until interrupted
+# ----------------------------------------------------------------------
+
+try:
+    server = DaemonServer(args.socket, {'detect': detect, 'similar': similar})
+except OSError as e:
+    stop(str(e), 1)
+signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Clean up the socket when killed too
+print("Serving detect and similar on {}.  Press Ctrl-C to stop.".format(args.socket), file=sys.stderr)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    os.remove(args.socket)
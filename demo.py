@@ -20,6 +20,7 @@ if version.parse(faceAPI.__version__) <= version.parse('0.3.0'):
 else:
     from azure.cognitiveservices.vision.face import FaceClient
 from mlhub.pkg import azkey
+import readline  # Don't remove !! For prompt of input() to take effect
 from msrest.authentication import CognitiveServicesCredentials  # To hold the subscription key
 from utils import (
     KEY_FILE,
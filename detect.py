@@ -1,25 +1,45 @@
 import argparse
+import os
+import sys
 
-from packaging import version
-import azure.cognitiveservices.vision.face as faceAPI
-if version.parse(faceAPI.__version__) <= version.parse('0.3.0'):
-    from azure.cognitiveservices.vision.face.face_client import FaceClient  # The main interface to access Azure face API
-else:
-    from azure.cognitiveservices.vision.face import FaceClient
-from msrest.authentication import CognitiveServicesCredentials  # To hold the subscription key
-
-from mlhub.pkg import (
-    azkey,
-    is_url,
-)
+from mlhub.pkg import is_url
 
 from utils import (
-    SERVICE,
-    azface_detect,
+    DETECTION_SCHEMA,
+    DEDUP_DISTANCE,
+    DETECT_WORKERS,
+    MOSAIC_CELL,
+    MOSAIC_PADDING,
+    MOSAIC_SIDE,
+    STATS,
+    TILE_OVERLAP,
+    TILE_SIDE,
+    WATCH_INTERVAL,
+    call_daemon,
+    detect_photos,
+    expand_paths,
     get_abspath,
-    get_face_api_key_endpoint,
+    get_detection_cache,
+    get_detection_marks,
+    get_detection_records,
+    get_duplicate_index,
+    get_face_client,
+    get_key_endpoint,
+    get_manifest,
+    get_prefilter,
+    get_renderer,
+    get_result_writer,
+    get_retry_policy,
     option_parser,
+    output_parser,
     print_detection_results,
+    profile_parser,
+    render_parser,
+    start_profile,
+    stop,
+    stop_profile,
+    use_daemon,
+    watch_paths,
 )
 
 
@@ -29,34 +49,244 @@ from utils import (
 
 parser = argparse.ArgumentParser(
     prog='detect',
-    parents=[option_parser],
-    description='Detect faces in an image.'
+    parents=[option_parser, output_parser, render_parser, profile_parser],
+    description='Detect faces in images.'
 )
 
 parser.add_argument(
     'path',
     type=str,
-    help='path or URL of a photo where faces will be detected')
+    nargs='*',
+    help='path or URL of a photo, a folder or a glob of photos where faces will be detected (default: read from stdin)')
+
+parser.add_argument(
+    '--depth',
+    type=int,
+    default=0,
+    help='level of photos to be detected in folders, -1 for all levels (default: 0)')
+
+parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    default=DETECT_WORKERS,
+    help='number of concurrent requests to Azure face API (default: {})'.format(DETECT_WORKERS))
+
+parser.add_argument(
+    '--engine',
+    choices=['threads', 'asyncio'],
+    default='threads',
+    help='run concurrent requests on a thread pool or on an asyncio event loop (default: threads)')
+
+parser.add_argument(
+    '--dedup',
+    action='store_true',
+    help='reuse the faces of a photo for its near-duplicates, such as burst shots or resized copies')
+
+parser.add_argument(
+    '--dedup-distance',
+    type=int,
+    default=DEDUP_DISTANCE,
+    help='max bits differing between the perceptual hashes of near-duplicates, of 64 (default: {})'.format(
+        DEDUP_DISTANCE))
+
+parser.add_argument(
+    '--mosaic',
+    action='store_true',
+    help='detect small photos, such as profile thumbnails, many at a time by tiling them into one image per call')
+
+parser.add_argument(
+    '--mosaic-cell',
+    type=int,
+    default=MOSAIC_CELL,
+    help='max pixels on the longer side of the photos tiled by --mosaic, up to {} (default: {})'.format(
+        MOSAIC_SIDE - 2 * MOSAIC_PADDING, MOSAIC_CELL))
+
+parser.add_argument(
+    '--tiles',
+    action='store_true',
+    help='detect large photos, such as group photos, tile by tile enlarged, to find faces too small otherwise')
+
+parser.add_argument(
+    '--tile-side',
+    type=int,
+    default=TILE_SIDE,
+    help='pixels on each side of the tiles of --tiles, larger photos are tiled (default: {})'.format(TILE_SIDE))
+
+parser.add_argument(
+    '--tile-overlap',
+    type=int,
+    default=TILE_OVERLAP,
+    help='pixels of overlap between the tiles of --tiles (default: {})'.format(TILE_OVERLAP))
+
+parser.add_argument(
+    '--manifest',
+    type=str,
+    metavar='FILE',
+    help='record the photos detected in FILE, and only detect photos which are new or changed since')
+
+parser.add_argument(
+    '--watch',
+    action='store_true',
+    help='keep watching the folders for new photos and detect them as they arrive, until interrupted')
+
+parser.add_argument(
+    '--watch-interval',
+    type=float,
+    default=WATCH_INTERVAL,
+    help='seconds between scans of the folders watched by --watch (default: {})'.format(WATCH_INTERVAL))
 
 args = parser.parse_args()
 
+if args.format == 'parquet' and not args.output:
+    parser.error("--format parquet requires --output")
+
+if args.watch and not args.path:
+    parser.error("--watch requires folders to watch")
+
+if args.dedup and args.engine == 'asyncio':
+    parser.error("--dedup requires --engine threads")
+
+if args.mosaic and args.engine == 'asyncio':
+    parser.error("--mosaic requires --engine threads")
+
+if args.mosaic and not 0 < args.mosaic_cell <= MOSAIC_SIDE - 2 * MOSAIC_PADDING:
+    parser.error("--mosaic-cell must be from 1 to {}".format(MOSAIC_SIDE - 2 * MOSAIC_PADDING))
+
+if args.tiles and args.engine == 'asyncio':
+    parser.error("--tiles requires --engine threads")
+
+if args.tiles and not 0 <= args.tile_overlap < args.tile_side:
+    parser.error("--tile-overlap must be less than --tile-side")
+
 # ----------------------------------------------------------------------
 # Setup
 # ----------------------------------------------------------------------
 
-img_url = args.path if is_url(args.path) else get_abspath(args.path)
+manifest = get_manifest(args)
+img_urls = expand_paths(args.path, args.depth)  # Lazily expanded, so large archives are streamed
+if manifest is not None:
+    img_urls = (img_url for img_url in img_urls if manifest.is_changed(img_url))
+single = len(args.path) == 1 and (is_url(args.path[0]) or os.path.isfile(get_abspath(args.path[0])))
+tagged = not single or args.watch  # Tag each result with its photo unless only one photo is given
 face_attrs = ['age', 'gender', 'glasses', 'emotion', 'occlusion']
-subscription_key, endpoint = args.key, args.endpoint
+detect_kwargs = dict(
+    max_side=args.max_side,
+    max_bytes=args.max_bytes,
+    tile_side=args.tile_side if args.tiles else None,
+    tile_overlap=args.tile_overlap,
+    return_face_id=False,  # Face IDs are not printed, so cached results never expire
+    return_face_attributes=face_attrs)
+profiling = start_profile(args)  # Stages are only timed in this process, so profiling bypasses the daemon
+
+
+# ----------------------------------------------------------------------
+# Ask the daemon, if running, to detect faces with its warm client
+# ----------------------------------------------------------------------
+
+if use_daemon(args) and args.engine == 'threads' and not profiling and manifest is None:
+    status = call_daemon(args.socket, 'detect', dict(
+        tagged=tagged,
+        workers=args.workers,
+        no_cache=args.no_cache,
+        prefilter=args.prefilter_threshold if args.prefilter else None,
+        dedup=args.dedup_distance if args.dedup else None,
+        mosaic=args.mosaic_cell if args.mosaic else None,
+        format=args.format,
+        output=get_abspath(args.output) if args.output else None,
+        render=get_abspath(args.render) if args.render else None,
+        render_format=args.render_format,
+        render_workers=args.render_workers,
+        stats=args.stats,
+        **detect_kwargs), stream=('img_urls', img_urls))
+    if status is not None:
+        sys.exit(status)
 
 
 # ----------------------------------------------------------------------
 # Call face API to detect and describe faces
 # ----------------------------------------------------------------------
 
-if not subscription_key or not endpoint:  # Request subscription key and endpoint from user.
-    subscription_key, endpoint = get_face_api_key_endpoint(*azkey(args.key_file, SERVICE, verbose=False))
+cache = get_detection_cache(args)
+prefilter = get_prefilter(args)
+dedup = get_duplicate_index(args)
+renderer = get_renderer(args)
+try:
+    writer = get_result_writer(args.format, DETECTION_SCHEMA, get_abspath(args.output) if args.output else None)
+except ImportError as e:
+    stop(str(e), 1)
+
+if args.engine == 'asyncio':
+    from aioface import (
+        AsyncFaceClient,
+        azface_detect_many_async,
+        run,
+    )
+
+    subscription_key, endpoint = get_key_endpoint(args)
+
+    async def detect_all(img_urls):
+        failed = 0
+        async with AsyncFaceClient(
+                endpoint, subscription_key, concurrency=args.workers, policy=get_retry_policy(args)) as client:
+            async for img_url, faces in azface_detect_many_async(
+                    client, img_urls, cache=cache, prefilter=prefilter, manifest=manifest, **detect_kwargs):
+                if faces is None:
+                    failed += 1
+                if writer is not None:
+                    writer.write_all(get_detection_records(faces or [], img_url))
+                else:
+                    print_detection_results(faces, tag=img_url if tagged else None)
+                if renderer is not None and faces:
+                    renderer.submit([(img_url, get_detection_marks(faces))], img_url)
+        return failed
+
+    def detect(img_urls):
+        return run(detect_all(img_urls))
+
+else:
+    client = get_face_client(args)
+
+    def detect(img_urls):
+        return detect_photos(
+            client,
+            img_urls,
+            tagged=tagged,
+            workers=args.workers,
+            cache=cache,
+            prefilter=prefilter,
+            dedup=dedup,
+            mosaic=args.mosaic_cell if args.mosaic else None,
+            renderer=renderer,
+            writer=writer,
+            manifest=manifest,
+            **detect_kwargs)
+
+failed = 0  # Photos that failed are reported on stderr and fail the command
+try:
+    if args.watch:
+        try:
+            for photos in watch_paths(args.path, manifest, args.depth, args.watch_interval):
+                failed += detect(photos)
+                if writer is not None:
+                    writer.flush()
+                sys.stdout.flush()
+        except KeyboardInterrupt:  # The way to stop watching
+            pass
+    else:
+        failed = detect(img_urls)
+finally:
+    if writer is not None:
+        writer.close()
+    if renderer is not None:
+        renderer.close()
+    if manifest is not None:
+        manifest.close()
+
+if profiling:
+    stop_profile(args)
+
+if args.stats:
+    STATS.report()
 
-credentials = CognitiveServicesCredentials(subscription_key)  # Set credentials
-client = FaceClient(endpoint, credentials)  # Setup Azure face API client
-faces = azface_detect(client, img_url, return_face_attributes=face_attrs)
-print_detection_results(faces)
+if failed:
+    sys.exit(1)
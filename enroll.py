@@ -0,0 +1,100 @@
+import argparse
+import os
+
+from utils import (
+    DETECT_WORKERS,
+    PERSON_GROUP_ID,
+    STATS,
+    TRAIN_INTERVAL,
+    FaceIndex,
+    PersonGroup,
+    TrainingScheduler,
+    azface_enroll,
+    get_abspath,
+    get_face_client,
+    list_people,
+    option_parser,
+    stop,
+)
+
+
+# ----------------------------------------------------------------------
+# Parse command line arguments
+# ----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    prog='enroll',
+    parents=[option_parser],
+    description='Enroll the faces of persons into a person group for identification.'
+)
+
+parser.add_argument(
+    'path',
+    type=str,
+    help='folder with a sub-folder of photos per person, named after the person, as docs/photo/PersonGroup')
+
+parser.add_argument(
+    '--person-group',
+    type=str,
+    default=PERSON_GROUP_ID,
+    help='ID of the Azure person group to enroll persons into (default: {})'.format(PERSON_GROUP_ID))
+
+parser.add_argument(
+    '--large',
+    action='store_true',
+    help='use a large person group, for up to a million persons, instead of a person group')
+
+parser.add_argument(
+    '--train-interval',
+    type=float,
+    default=TRAIN_INTERVAL,
+    help='min seconds between trainings while enrolling, 0 to train only at the end (default: {})'.format(
+        TRAIN_INTERVAL))
+
+parser.add_argument(
+    '--index-file',
+    type=str,
+    help='file that records enrolled photos, so that only new photos are enrolled when run again')
+
+parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    default=DETECT_WORKERS,
+    help='number of concurrent requests to Azure face API (default: {})'.format(DETECT_WORKERS))
+
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------
+# Setup
+# ----------------------------------------------------------------------
+
+path = get_abspath(args.path)
+if not os.path.isdir(path):
+    stop("{} is not a folder".format(args.path), 1)
+
+people = list_people(path)
+if not people:
+    stop("No photos of persons found in {}".format(args.path), 1)
+
+
+# ----------------------------------------------------------------------
+# Call face API to add the faces of persons and train the person group
+# ----------------------------------------------------------------------
+
+client = get_face_client(args)
+group = PersonGroup(client, args.person_group, large=args.large)
+index = FaceIndex(get_abspath(args.index_file), group.key) if args.index_file else None
+scheduler = TrainingScheduler(group, interval=args.train_interval or None)
+
+try:
+    for name, img_url, persisted_face_id in azface_enroll(
+            group, people, workers=args.workers, index=index, scheduler=scheduler):
+        if persisted_face_id is not None:
+            STATS.count('enrolled faces')
+            print("{},{},{}".format(name, img_url, persisted_face_id))
+    scheduler.close()
+except RuntimeError as e:
+    stop(str(e), 1)
+
+if args.stats:
+    STATS.report()
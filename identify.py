@@ -0,0 +1,106 @@
+import argparse
+import os
+
+from mlhub.pkg import is_url
+
+from utils import (
+    DETECT_WORKERS,
+    PERSON_GROUP_ID,
+    STATS,
+    PersonGroup,
+    expand_paths,
+    get_abspath,
+    get_detection_cache,
+    get_face_client,
+    get_prefilter,
+    identify_photos,
+    option_parser,
+    stop,
+)
+
+
+# ----------------------------------------------------------------------
+# Parse command line arguments
+# ----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    prog='identify',
+    parents=[option_parser],
+    description='Identify the persons enrolled by the enroll command in images.'
+)
+
+parser.add_argument(
+    'path',
+    type=str,
+    nargs='*',
+    help='path or URL of a photo, a folder or a glob of photos of persons to be identified (default: read from stdin)')
+
+parser.add_argument(
+    '--person-group',
+    type=str,
+    default=PERSON_GROUP_ID,
+    help='ID of the trained Azure person group of the persons (default: {})'.format(PERSON_GROUP_ID))
+
+parser.add_argument(
+    '--large',
+    action='store_true',
+    help='the person group is a large person group, as enrolled by enroll --large')
+
+parser.add_argument(
+    '--top',
+    type=int,
+    default=1,
+    help='number of most likely persons of each face (default: 1)')
+
+parser.add_argument(
+    '--threshold',
+    type=float,
+    help='min confidence, from 0 to 1, of the persons identified (default: that of the person group)')
+
+parser.add_argument(
+    '--depth',
+    type=int,
+    default=0,
+    help='level of photos to be identified in folders, -1 for all levels (default: 0)')
+
+parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    default=DETECT_WORKERS,
+    help='number of concurrent requests to Azure face API (default: {})'.format(DETECT_WORKERS))
+
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------
+# Setup
+# ----------------------------------------------------------------------
+
+img_urls = expand_paths(args.path, args.depth)
+single = len(args.path) == 1 and (is_url(args.path[0]) or os.path.isfile(get_abspath(args.path[0])))
+tagged = not single  # Tag each result with its photo unless only one photo is given
+
+
+# ----------------------------------------------------------------------
+# Call face API to detect faces and identify them among the persons
+# ----------------------------------------------------------------------
+
+client = get_face_client(args)
+
+try:
+    identify_photos(
+        client,
+        img_urls,
+        PersonGroup(client, args.person_group, large=args.large),
+        tagged=tagged,
+        workers=args.workers,
+        top=args.top,
+        threshold=args.threshold,
+        cache=get_detection_cache(args),
+        prefilter=get_prefilter(args),
+        max_side=args.max_side,
+        max_bytes=args.max_bytes)
+except RuntimeError as e:
+    stop(str(e), 1)
+
+if args.stats:
+    STATS.report()
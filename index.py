@@ -0,0 +1,83 @@
+import argparse
+
+from utils import (
+    DETECT_WORKERS,
+    FACE_LIST_ID,
+    FaceIndex,
+    INDEX_FILE,
+    STATS,
+    azface_index,
+    expand_paths,
+    get_abspath,
+    get_face_client,
+    get_prefilter,
+    getbox_points,
+    option_parser,
+)
+
+
+# ----------------------------------------------------------------------
+# Parse command line arguments
+# ----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    prog='index',
+    parents=[option_parser],
+    description='Index the faces in images for searching by similar.'
+)
+
+parser.add_argument(
+    'path',
+    type=str,
+    nargs='*',
+    help='path or URL of a photo, a folder or a glob of photos to be indexed (default: read from stdin)')
+
+parser.add_argument(
+    '--depth',
+    type=int,
+    default=-1,
+    help='level of photos to be indexed in folders, -1 for all levels (default: -1)')
+
+parser.add_argument(
+    '--face-list',
+    type=str,
+    default=FACE_LIST_ID,
+    help='ID of the Azure LargeFaceList to index faces into (default: {})'.format(FACE_LIST_ID))
+
+parser.add_argument(
+    '--index-file',
+    type=str,
+    default=INDEX_FILE,
+    help='file that maps indexed faces to their photos')
+
+parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    default=DETECT_WORKERS,
+    help='number of concurrent requests to Azure face API (default: {})'.format(DETECT_WORKERS))
+
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------
+# Setup
+# ----------------------------------------------------------------------
+
+img_urls = expand_paths(args.path, args.depth)
+index = FaceIndex(get_abspath(args.index_file), args.face_list)
+
+
+# ----------------------------------------------------------------------
+# Call face API to enroll faces into the face list
+# ----------------------------------------------------------------------
+
+client = get_face_client(args)
+
+for img_url, faces in azface_index(client, img_urls, index, workers=args.workers, prefilter=get_prefilter(args)):
+    STATS.count('indexed photos')
+    STATS.count('indexed faces', len(faces))
+    for face in faces:
+        coordinates = " ".join([str(x) for x in getbox_points(face)])
+        print("{},{},{}".format(img_url, coordinates, face.persisted_face_id))
+
+if args.stats:
+    STATS.report()
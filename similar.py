@@ -1,29 +1,33 @@
 import argparse
 import os
+import sys
 
-from packaging import version
-import azure.cognitiveservices.vision.face as faceAPI
-if version.parse(faceAPI.__version__) <= version.parse('0.3.0'):
-    from azure.cognitiveservices.vision.face.face_client import FaceClient  # The main interface to access Azure face API
-else:
-    from azure.cognitiveservices.vision.face import FaceClient
-
-from msrest.authentication import CognitiveServicesCredentials  # To hold the subscription key
-
-from mlhub.pkg import (
-    azkey,
-    is_url,
-)
+from mlhub.pkg import is_url
 
 from utils import (
-    SERVICE,
-    azface_detect,
-    azface_similar,
+    DETECT_WORKERS,
+    FACE_LIST_ID,
+    FaceIndex,
+    INDEX_FILE,
+    SIMILAR_SCHEMA,
+    STATS,
+    call_daemon,
+    expand_paths,
     get_abspath,
-    get_face_api_key_endpoint,
+    get_detection_cache,
+    get_face_client,
+    get_prefilter,
+    get_renderer,
+    get_result_writer,
     option_parser,
-    print_similar_results,
+    output_parser,
+    profile_parser,
+    render_parser,
+    similar_photos,
+    start_profile,
     stop,
+    stop_profile,
+    use_daemon,
 )
 
 # ----------------------------------------------------------------------
@@ -32,54 +36,147 @@ from utils import (
 
 parser = argparse.ArgumentParser(
     prog='similar',
-    parents=[option_parser],
+    parents=[option_parser, output_parser, render_parser, profile_parser],
     description='Find similar faces between images.'
 )
 
 parser.add_argument(
     'target',
-    help='path or URL of a photo of the faces to be found')
+    help='path or URL of a photo, a folder or a glob of photos of the faces to be found')
 
 parser.add_argument(
     'candidate',
-    help='path or URL of a photo to find expected target faces')
+    nargs='?',
+    help='path or URL of a photo, a folder or a glob of photos to find expected target faces')
+
+parser.add_argument(
+    '--index',
+    action='store_true',
+    help='search the faces indexed by the index command instead of candidate photos')
+
+parser.add_argument(
+    '--face-list',
+    type=str,
+    default=FACE_LIST_ID,
+    help='ID of the Azure LargeFaceList of indexed faces (default: {})'.format(FACE_LIST_ID))
+
+parser.add_argument(
+    '--index-file',
+    type=str,
+    default=INDEX_FILE,
+    help='file that maps indexed faces to their photos')
+
+parser.add_argument(
+    '--top',
+    type=int,
+    default=1,
+    help='number of best matches of each target face to be found in the index (default: 1)')
+
+parser.add_argument(
+    '--threshold',
+    type=float,
+    help='min confidence, from 0 to 1, of the faces matched in candidate photos (default: any found similar)')
+
+parser.add_argument(
+    '--depth',
+    type=int,
+    default=0,
+    help='level of photos to be used in folders, -1 for all levels (default: 0)')
+
+parser.add_argument(
+    '-j', '--workers',
+    type=int,
+    default=DETECT_WORKERS,
+    help='number of concurrent requests to Azure face API (default: {})'.format(DETECT_WORKERS))
 
 args = parser.parse_args()
 
+if (args.candidate is None) != args.index:
+    parser.error("either a candidate photo or --index is required")
+
+if args.format == 'parquet' and not args.output:
+    parser.error("--format parquet requires --output")
+
+if args.render and args.index:
+    parser.error("--render is only available with candidate photos")
+
 # ----------------------------------------------------------------------
 # Setup
 # ----------------------------------------------------------------------
-target_url = args.target if is_url(args.target) else get_abspath(args.target)  # Get the photo of target faces
-candidate_url = args.candidate if is_url(args.candidate) else get_abspath(args.candidate)  # Get the photo to be checked
-subscription_key, endpoint = args.key, args.endpoint
 
-if os.path.isdir(target_url) or os.path.isdir(candidate_url):
-    stop("Only one photo allowed!")
 
-# ----------------------------------------------------------------------
-# Prepare Face API client
-# ----------------------------------------------------------------------
+def is_single(path):
+    return is_url(path) or os.path.isfile(get_abspath(path))
 
-if not subscription_key or not endpoint:  # Request subscription key and endpoint from user.
-    subscription_key, endpoint = get_face_api_key_endpoint(*azkey(args.key_file, SERVICE, verbose=False))
 
-credentials = CognitiveServicesCredentials(subscription_key)  # Set credentials
-client = FaceClient(endpoint, credentials)  # Setup Azure face API client
+target_urls = list(expand_paths([args.target], args.depth))  # Get the photos of target faces
+candidate_urls = list(expand_paths([args.candidate], args.depth)) if args.candidate else []  # Get the photos to be checked
+tagged = not (is_single(args.target) and (args.index or is_single(args.candidate)))  # Tag results with the photos if many
+similar_kwargs = dict(
+    tagged=tagged,
+    workers=args.workers,
+    top=args.top,
+    threshold=args.threshold,
+    max_side=args.max_side,
+    max_bytes=args.max_bytes)
+profiling = start_profile(args)  # Stages are only timed in this process, so profiling bypasses the daemon
 
 
 # ----------------------------------------------------------------------
-# Detect faces
+# Ask the daemon, if running, to find similar faces with its warm client
 # ----------------------------------------------------------------------
 
-target_faces = azface_detect(client, target_url)
-candidate_faces = azface_detect(client, candidate_url)
-if not target_faces or not candidate_faces:
-    stop("No faces found!")
+if use_daemon(args) and not profiling:
+    status = call_daemon(args.socket, 'similar', dict(
+        target_urls=target_urls,
+        candidate_urls=candidate_urls,
+        face_list=args.face_list if args.index else None,
+        index_file=get_abspath(args.index_file),
+        no_cache=args.no_cache,
+        prefilter=args.prefilter_threshold if args.prefilter else None,
+        format=args.format,
+        output=get_abspath(args.output) if args.output else None,
+        render=get_abspath(args.render) if args.render else None,
+        render_format=args.render_format,
+        render_workers=args.render_workers,
+        stats=args.stats,
+        **similar_kwargs))
+    if status is not None:
+        sys.exit(status)
 
 
 # ----------------------------------------------------------------------
-# Find similar faces
+# Call face API to detect faces and find similar ones
 # ----------------------------------------------------------------------
 
-matches = azface_similar(client, target_faces, candidate_faces)
-print_similar_results(target_faces, candidate_faces, matches)
+client = get_face_client(args)
+index = FaceIndex(get_abspath(args.index_file), args.face_list) if args.index else None
+renderer = get_renderer(args)
+try:
+    writer = get_result_writer(args.format, SIMILAR_SCHEMA, get_abspath(args.output) if args.output else None)
+except ImportError as e:
+    stop(str(e), 1)
+try:
+    found = similar_photos(
+        client,
+        target_urls,
+        candidate_urls,
+        index=index,
+        cache=get_detection_cache(args),
+        prefilter=get_prefilter(args),
+        renderer=renderer,
+        writer=writer,
+        **similar_kwargs)
+finally:
+    if writer is not None:
+        writer.close()
+    if renderer is not None:
+        renderer.close()
+    if profiling:
+        stop_profile(args)
+
+if not found:
+    stop("No faces found!")
+
+if args.stats:
+    STATS.report()
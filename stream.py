@@ -0,0 +1,124 @@
+import argparse
+
+from mlhub.pkg import is_url
+
+from utils import (
+    KEYFRAME_INTERVAL,
+    SCENE_CHANGE,
+    STATS,
+    azface_track,
+    get_abspath,
+    get_face_client,
+    get_prefilter,
+    getbox,
+    mark_face,
+    open_video,
+    option_parser,
+    print_detection_results,
+    stop,
+)
+
+
+# ----------------------------------------------------------------------
+# Parse command line arguments
+# ----------------------------------------------------------------------
+
+parser = argparse.ArgumentParser(
+    prog='stream',
+    parents=[option_parser],
+    description='Detect faces in a video or camera stream.'
+)
+
+parser.add_argument(
+    'source',
+    type=str,
+    nargs='?',
+    default='0',
+    help='camera number, path or URL of a video where faces will be detected (default: camera 0)')
+
+parser.add_argument(
+    '--threshold',
+    type=float,
+    default=SCENE_CHANGE,
+    help='change of the scene, from 0 to 1, which triggers a new detection (default: {})'.format(SCENE_CHANGE))
+
+parser.add_argument(
+    '--interval',
+    type=int,
+    default=KEYFRAME_INTERVAL,
+    help='max number of frames between detections (default: {})'.format(KEYFRAME_INTERVAL))
+
+parser.add_argument(
+    '--output',
+    type=str,
+    help='video file to save the frames with faces marked')
+
+parser.add_argument(
+    '--no-display',
+    action='store_true',
+    help='do not show the frames in a window')
+
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------
+# Setup
+# ----------------------------------------------------------------------
+
+import cv2 as cv  # Only after parsing, so that --help is fast
+
+source = args.source if args.source.isdigit() or is_url(args.source) else get_abspath(args.source)
+output = get_abspath(args.output) if args.output else None
+try:
+    capture = open_video(source)
+except IOError as e:
+    stop(str(e), 1)
+
+face_attrs = ['age', 'gender', 'glasses', 'emotion', 'occlusion']
+writer = None
+
+
+# ----------------------------------------------------------------------
+# Call face API on key frames and track faces in between
+# ----------------------------------------------------------------------
+
+client = get_face_client(args)
+
+frames = azface_track(
+    client,
+    capture,
+    threshold=args.threshold,
+    interval=args.interval,
+    prefilter=get_prefilter(args),
+    max_side=args.max_side,
+    max_bytes=args.max_bytes,
+    return_face_attributes=face_attrs)
+
+try:
+    for number, frame, faces in frames:
+        print_detection_results(faces, tag=number)
+
+        for i, face in enumerate(faces):
+            mark_face(frame, getbox(face), text=str(i))
+
+        if output:
+            if writer is None:
+                height, width = frame.shape[:2]
+                fps = capture.get(cv.CAP_PROP_FPS) or 25
+                writer = cv.VideoWriter(output, cv.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+            writer.write(frame)
+
+        if not args.no_display:
+            cv.imshow('azface stream (press q to quit)', frame)
+            if cv.waitKey(1) & 0xFF == ord('q'):
+                break
+except KeyboardInterrupt:
+    pass
+finally:
+    capture.release()
+    if writer is not None:
+        writer.release()
+    if not args.no_display:
+        cv.destroyAllWindows()
+
+if args.stats:
+    STATS.report()
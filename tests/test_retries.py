@@ -0,0 +1,33 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+#
+# Check that calls to Azure face API are retried by the RetryPolicy alone,
+# by counting the calls received by the fake service of bench/fakeapi.py.
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+pytest.importorskip('mlhub')
+face = pytest.importorskip('azure.cognitiveservices.vision.face')
+authentication = pytest.importorskip('msrest.authentication')
+
+from fakeapi import FakeFaceAPI  # noqa: E402
+from utils import RetryPolicy, ThrottledClient  # noqa: E402
+
+
+@pytest.mark.parametrize('retries', [0, 1, 3])
+def test_failed_call_is_made_once_per_attempt(retries):
+    with FakeFaceAPI(error_rate=1.0) as api:
+        client = ThrottledClient(
+            face.FaceClient(api.endpoint, authentication.CognitiveServicesCredentials('fake')),
+            RetryPolicy(retries=retries, backoff=0))
+        with pytest.raises(Exception):
+            client.person_group.get('azface')
+
+    assert sum(api.calls.values()) == retries + 1
@@ -1,20 +1,36 @@
 import argparse
-import cv2 as cv
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import functools
+import glob
 import hashlib
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import numpy as np
+import io
+import json
+import math
+import mmap
 import os
-import readline  # Don't remove !! For prompt of input() to take effect
+import random
+import socket
+import sqlite3
 import sys
-import toolz
-import urllib.error
-import urllib.parse
-import urllib.request
+import threading
+import time
 import uuid
+import warnings
+
+# OpenCV, numpy, matplotlib, urllib, readline and asyncio are slow to
+# import, so they are imported by the functions using them, and commands
+# which only print text start fast.
 
 from mlhub import utils as mlutils
-from mlhub.pkg import is_url
+from mlhub.pkg import (
+    azkey,
+    is_url,
+)
 
 # ----------------------------------------------------------------------
 # Constants
@@ -24,11 +40,77 @@ MARK_COLOR = (0, 255, 0)  # Green.  This color remains the same in RGB (matplotl
 MARK_WIDTH = 4
 TEXT_COLOR = MARK_COLOR
 LINE_WIDTH = 2
-TEXT_FONT = cv.FONT_HERSHEY_SIMPLEX
+TEXT_FONT = 0  # cv.FONT_HERSHEY_SIMPLEX
 TEXT_SIZE = 1
 
 SERVICE = "Face API"
 KEY_FILE = os.path.join(os.getcwd(), "private.txt")
+SOCKET_FILE = os.path.join(os.getcwd(), "azface.sock")  # Unix socket of the daemon
+DAEMON_OPTIONS = ['--key', '--endpoint', '--key-file', '--cache-file', '--tps', '--retries']  # Fixed when the daemon starts
+
+CHUNK_SIZE = 64 * 1024  # Size of chunks in which photos are read and downloaded
+
+DETECT_WORKERS = 8  # Default number of concurrent requests to Azure face API
+MAX_SIMILAR_CANDIDATES = 1000  # Max number of candidate face IDs in one find_similar call
+
+CACHE_FILE = os.path.join(os.getcwd(), "cache.db")
+CACHE_SIZE = 100000  # Max number of detection results kept in the cache
+CACHE_EVICT = 0.1  # Fraction of the cache evicted at once when full, so that its size is not checked per result
+FACE_ID_TTL = 24 * 60 * 60  # Face IDs expire in Azure face API after 24 hours
+FACE_ID_MARGIN = 60 * 60  # Cached face IDs are dropped this long before they expire, so they are still valid when used
+
+RETRIES = 5  # Default max number of retries of a throttled or failed call
+BACKOFF = 1  # Seconds of the first backoff before retrying a failed call, doubled per retry
+MAX_BACKOFF = 60  # Max seconds of backoff before retrying a failed call
+
+MANIFEST_COMMIT = 1000  # Number of photos recorded in a manifest between commits
+WATCH_INTERVAL = 5  # Seconds between scans of watched folders
+WATCH_SETTLE = 2  # Seconds since last modified before a new photo in a watched folder is processed
+
+INDEX_FILE = os.path.join(os.getcwd(), "index.db")
+FACE_LIST_ID = "azface"  # Default LargeFaceList of indexed candidate faces
+
+PERSON_GROUP_ID = "azface"  # Default person group of enrolled persons
+TRAIN_INTERVAL = 300  # Min seconds between trainings of a person group while enrolling
+IDENTIFY_BATCH = 10  # Max number of faces identified by one call
+LIST_PAGE_SIZE = 1000  # Max number of persons listed by one call
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png')  # Photo formats accepted by Azure face API
+
+MIN_FACE_SIZE = 36  # Smallest face in pixels detectable by Azure face API
+MAX_UPLOAD_SIZE = 6 * 1024 * 1024  # Largest photo in bytes accepted by Azure face API
+MAX_IMAGE_SIDE = 4096  # Largest side in pixels of a photo accepted by Azure face API
+UPLOAD_MIN_FACE = 2 * MIN_FACE_SIZE  # Smallest face in an original photo kept detectable when downscaled
+UPLOAD_QUALITY = 90  # JPEG quality of photos re-encoded before upload
+
+DISPLAY_SIDE = 1600  # Photos are decoded at most this many pixels on the longer side for display
+
+RENDER_WORKERS = os.cpu_count() or 1  # Default number of processes rendering marked photos
+RENDER_QUALITY = 90  # JPEG quality of rendered photos
+
+WRITE_BUFFER = 1000  # Number of result records written to a file at a time
+PARQUET_ROW_GROUP = 100000  # Number of result records in each row group of Parquet files
+
+PREFILTER_CASCADE = 'haarcascade_frontalface_default.xml'  # OpenCV cascade screening photos for faces
+PREFILTER_THRESHOLD = 0.0  # Min cascade confidence of a face for a photo to be sent to Azure face API
+PREFILTER_SIDE = 640  # Photos are screened at most this many pixels on the longer side
+
+DEDUP_DISTANCE = 4  # Default max number of bits differing between the dHashes of near-duplicate photos
+DHASH_SIDE = 128  # Photos are hashed at most this many pixels on the longer side
+
+MOSAIC_SIDE = 2048  # Max pixels on each side of a mosaic of small photos detected by one call
+MOSAIC_CELL = 256  # Default max pixels on the longer side of a photo tiled into a mosaic
+MOSAIC_PADDING = 16  # Pixels between the photos of a mosaic
+MOSAIC_MAX_FACES = 100  # Max number of faces returned by one detect call, beyond which faces are lost
+
+TILE_SIDE = 512  # Default pixels on each side of the tiles of a large photo detected tile by tile
+TILE_OVERLAP = 64  # Default pixels of overlap between tiles, which faces smaller than are whole in a tile
+TILE_ZOOM = 2  # Tiles are enlarged by this factor, so that faces down to MIN_FACE_SIZE / TILE_ZOOM are detected
+TILE_IOU = 0.3  # Min intersection over union of the rectangles of the same face found in different tiles
+
+PROFILE_BUCKETS = [0.0001 * 2 ** i for i in range(21)]  # Upper bounds in seconds of profile histogram buckets
+
+SCENE_CHANGE = 0.1  # Mean change of pixels between frames which triggers a new detection
+KEYFRAME_INTERVAL = 30  # Max number of frames between detections
 
 # ----------------------------------------------------------------------
 # Command line argument parser
@@ -58,6 +140,122 @@ option_parser.add_argument(
     type=str,
     help='endpoint of Azure face API service')
 
+option_parser.add_argument(
+    '--socket',
+    type=str,
+    help='Unix socket of the daemon which serves commands with a warm client, '
+         'unless any of {} is given'.format(', '.join(DAEMON_OPTIONS)),
+    default=SOCKET_FILE)
+
+option_parser.add_argument(
+    '--no-daemon',
+    action='store_true',
+    help='run the command in this process even if the daemon is running, as when any of {} is given'.format(
+        ', '.join(DAEMON_OPTIONS)))
+
+option_parser.add_argument(
+    '--cache-file',
+    type=str,
+    help='file that caches detection results of local photos',
+    default=CACHE_FILE)
+
+option_parser.add_argument(
+    '--no-cache',
+    action='store_true',
+    help='do not use cached detection results')
+
+option_parser.add_argument(
+    '--stats',
+    action='store_true',
+    help='report statistics such as cache hits to stderr')
+
+option_parser.add_argument(
+    '--tps',
+    type=float,
+    help='max number of transactions per second to Azure face API, as allowed by your pricing tier')
+
+option_parser.add_argument(
+    '--retries',
+    type=int,
+    default=RETRIES,
+    help='max number of retries of a throttled or failed call (default: {})'.format(RETRIES))
+
+option_parser.add_argument(
+    '--max-side',
+    type=int,
+    help='downscale photos to at most this many pixels on the longer side before upload (service limit: {})'.format(
+        MAX_IMAGE_SIDE))
+
+option_parser.add_argument(
+    '--max-bytes',
+    type=int,
+    help='re-encode photos to at most this many bytes before upload (service limit: {})'.format(MAX_UPLOAD_SIZE))
+
+option_parser.add_argument(
+    '--prefilter',
+    action='store_true',
+    help='screen photos locally with OpenCV and skip those without faces')
+
+option_parser.add_argument(
+    '--prefilter-threshold',
+    type=float,
+    default=PREFILTER_THRESHOLD,
+    help='min confidence of a face found by --prefilter, higher skips more photos (default: {})'.format(
+        PREFILTER_THRESHOLD))
+
+# Options of the commands which can write their results as records
+
+output_parser = argparse.ArgumentParser(add_help=False)
+
+output_parser.add_argument(
+    '--format',
+    choices=['text', 'jsonl', 'csv', 'parquet'],
+    default='text',
+    help='format of the results, as text lines or as records of all face attributes (default: text)')
+
+output_parser.add_argument(
+    '--output',
+    type=str,
+    metavar='FILE',
+    help='file to write the records of --format to (default: stdout, required by parquet)')
+
+# Options of the commands which can render their results
+
+render_parser = argparse.ArgumentParser(add_help=False)
+
+render_parser.add_argument(
+    '--render',
+    type=str,
+    metavar='FOLDER',
+    help='save photos with the faces marked into this folder, without displaying them')
+
+render_parser.add_argument(
+    '--render-format',
+    choices=['jpg', 'png'],
+    default='jpg',
+    help='image format of the photos saved by --render (default: jpg)')
+
+render_parser.add_argument(
+    '--render-workers',
+    type=int,
+    default=RENDER_WORKERS,
+    help='number of processes rendering photos for --render (default: {})'.format(RENDER_WORKERS))
+
+# Options of the commands which can profile their stages
+
+profile_parser = argparse.ArgumentParser(add_help=False)
+
+profile_parser.add_argument(
+    '--profile',
+    action='store_true',
+    help='report the time taken by each stage, such as reading photos or calling the service, on stderr')
+
+profile_parser.add_argument(
+    '--profile-trace',
+    type=str,
+    metavar='FILE',
+    help='write every stage timed by --profile to FILE as a Chrome trace, for chrome://tracing or Perfetto')
+
 
 # ----------------------------------------------------------------------
 # File, folder, and I/O
@@ -79,38 +277,247 @@ def get_abspath(path):
     return os.path.abspath(path)
 
 
-def list_files(path, depth=0):
-    """List all files in <path> at level <depth>.  If depth < 0, list all files under <path>."""
+def list_files(path, depth=0, extensions=None):
+    """List all files in <path> at level <depth>.  If depth < 0, list all files under <path>.
+
+    As os.walk() did, files at the top of <path> are listed too when <depth>
+    is 1, and symbolic links to folders are not followed.  Only files with
+    one of <extensions>, such as IMAGE_EXTENSIONS, are listed if given.
+    Folders are scanned lazily and no deeper than <depth>, and the files are
+    listed in the order of their sorted paths, so that huge trees are
+    streamed.
+    """
+
+    return _list_files(path, depth, extensions, top=True)
+
 
-    path = os.path.join(path, '')
-    start = len(path)
-    for (root, dirs, files) in os.walk(path):
-        if depth < 0:
-            for file in files:
-                yield os.path.join(root, file)
+def _list_files(path, depth, extensions, top=False):
+    try:
+        entries = list(os.scandir(path))
+    except OSError:  # Unreadable or removed while listing
+        return
+
+    # Sorted by name, with a separator after folders, as their files would be in sorted paths
+
+    folders = set()
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                folders.add(entry.name)
+        except OSError:
+            continue
+
+    for entry in sorted(entries, key=lambda x: x.name + os.sep if x.name in folders else x.name):
+        if entry.name in folders:
+            if depth != 0:
+                yield from _list_files(entry.path, depth - 1, extensions)
+        elif depth <= 0 or (top and depth == 1):
+            try:
+                is_file = entry.is_file()
+            except OSError:
+                continue
+            if is_file and (extensions is None or os.path.splitext(entry.name)[1].lower() in extensions):
+                yield entry.path
+
+
+def read_paths(file=sys.stdin):
+    """Read paths or URLs from <file>, one per line, skipping blank lines."""
+
+    for line in file:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def expand_paths(paths, depth=0):
+    """Expand each of <paths> into the photos it refers to.
+
+    A path can be a URL, a photo, a glob pattern, or a folder, whose photos at
+    level <depth> are listed by list_files().  If <paths> is empty or '-', the
+    paths are read from stdin instead.
+    """
+
+    if not paths or paths == ['-']:
+        paths = read_paths()
+
+    for path in paths:
+        if is_url(path):
+            yield path
+            continue
+
+        path = get_abspath(path)
+        if os.path.isdir(path):
+            yield from list_files(path, depth, IMAGE_EXTENSIONS)
+        elif glob.has_magic(path):
+            for match in sorted(glob.glob(path)):
+                if os.path.isdir(match):
+                    yield from list_files(match, depth, IMAGE_EXTENSIONS)
+                else:
+                    yield match
         else:
-            segs = root[start:].split(os.path.sep)
-            if (depth == 0 and segs[0] == '') or len(segs) == depth:
-                for file in files:
-                    yield os.path.join(root, file)
+            yield path
+
+
+class FileManifest:
+    """Persistent record of the size, modification time and md5 digest of the photos processed.
+
+    The record is kept in the SQLite database <path>, or in memory if <path>
+    is ':memory:', so that repeat runs over a large archive only process the
+    photos which are new or changed since.  A photo whose size and time are
+    unchanged is deemed unchanged without being read, and one only touched is
+    deemed unchanged by its digest.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._added = 0
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+
+    def is_changed(self, path):
+        """Return whether the photo <path> is new or changed since recorded by add().  URLs always are."""
+
+        if is_url(path):
+            return True
+        try:
+            stat = os.stat(path)
+        except OSError:  # Left for the service call to report
+            return True
+
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime, digest FROM file WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return True
+        if row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return False
+        if row[0] != stat.st_size or get_hexdigest(path) != row[2]:
+            return True
+
+        with self._lock, self._conn:  # Only touched
+            self._conn.execute("UPDATE file SET mtime = ? WHERE path = ?", (stat.st_mtime_ns, path))
+        return False
+
+    def add(self, path, digest=None):
+        """Record the photo <path> as processed.  Records are committed in batches and by close().
+
+        <digest> is the md5 digest of the photo if already known, which saves
+        reading the photo again.
+        """
+
+        if is_url(path):
+            return
+        stat = os.stat(path)
+        if digest is None:
+            digest = get_hexdigest(path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, digest))
+            self._added += 1
+            if self._added % MANIFEST_COMMIT == 0:
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def get_manifest(args):
+    """Return the FileManifest according to command line <args>, or None if not used.
+
+    Watching folders without a manifest file records the photos in memory.
+    """
+
+    if args.manifest:
+        return FileManifest(get_abspath(args.manifest))
+    return FileManifest(':memory:') if args.watch else None
+
+
+def watch_paths(paths, manifest, depth=0, interval=WATCH_INTERVAL, settle=WATCH_SETTLE):
+    """Scan <paths> as expand_paths() does every <interval> seconds, forever, for photos new to <manifest>.
+
+    Yield a list of the new or changed photos found by each scan, the first of
+    which covers all the photos not yet in <manifest>.  Each list is to be
+    processed, and its photos recorded in <manifest>, before the next scan.
+    Photos modified in the last <settle> seconds, which may still be being
+    written, are left to a later scan.  Photos which failed, and so are not
+    recorded, are not retried until the next run.
+    """
+
+    failed = set()
+    while True:
+        start = time.time()
+        photos = []
+        for path in expand_paths(paths, depth):
+            if path in failed or not manifest.is_changed(path):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) < settle:
+                    continue
+            except OSError:  # Removed since listed
+                continue
+            photos.append(path)
+
+        yield photos
+        failed.update(path for path in photos if manifest.is_changed(path))
+        time.sleep(max(0, interval - (time.time() - start)))
 
 
 def download_img(url, folder, prefix):
     """Download image from <url> into <folder> with name as <prefix>_<md5>."""
 
+    path, digest, _ = ingest_img(url, folder, prefix)
+    return path, digest
+
+
+def ingest_img(url, folder, prefix, keep=False):
+    """Download image from <url> into <folder> with name as <prefix>_<md5> in a single pass.
+
+    The image is streamed in chunks, each of which is hashed and written to
+    disk as it arrives, so the file is never read back.  If <keep> is True,
+    the downloaded bytes are also returned for decoding and uploading.
+
+    Returns (path, digest, data) where data is None unless <keep> is True.
+    """
+
+    import urllib.request
+
     # Download image from <url> into a unique file path with <prefix>
 
     path = os.path.join(folder, get_unique_name(prefix))
-    urllib.request.urlretrieve(url, path)
-
-    return replace_uuid_with_digest(path)
+    md5 = hashlib.md5()
+    data = bytearray() if keep else None
+
+    try:
+        with urllib.request.urlopen(url) as response, open(path, 'wb') as file:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+                file.write(chunk)
+                if keep:
+                    data += chunk
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    digest = md5.hexdigest()
+    new_path = change_name_hash(path, digest)
+    os.rename(path, new_path)
+    return new_path, digest, data
 
 
 def get_hexdigest(path):
+    """Return the md5 digest of the file <path>, read in chunks to bound memory."""
+
+    md5 = hashlib.md5()
     with open(path, 'rb') as file:
-        digest = hashlib.md5(file.read()).hexdigest()
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
 
-    return digest
+    return md5.hexdigest()
 
 
 def get_unique_name(prefix):
@@ -156,25 +563,1146 @@ def stop(msg, status=0):
     sys.exit(status)
 
 
+# ----------------------------------------------------------------------
+# Daemon
+# ----------------------------------------------------------------------
+
+def use_daemon(args):
+    """Return whether the command with <args> may be served by the daemon.
+
+    The daemon keeps the client, rate limiter and cache it was started with,
+    so commands given any of DAEMON_OPTIONS run in this process instead.
+    """
+
+    if args.no_daemon:
+        return False
+    return all(getattr(args, dest) == option_parser.get_default(dest)
+               for dest in (x.lstrip('-').replace('-', '_') for x in DAEMON_OPTIONS))
+
+
+def call_daemon(path, command, params, stream=None):
+    """Ask the daemon listening on the Unix socket <path> to run <command> with <params>.
+
+    If <stream> is given as (name, items), the daemon passes the iterable
+    <items> to the command as the parameter <name>, and <items> is only
+    iterated once the daemon has accepted the connection, sending each item
+    as it comes so that the command starts before <items> are exhausted.
+    The output of the command is copied to stdout and stderr.  Returns the
+    exit status of the command, or None if no daemon is running.
+    """
+
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+    except (AttributeError, OSError):  # No daemon, or no Unix sockets on this platform
+        return None
+
+    with conn, conn.makefile('rb') as rfile, conn.makefile('wb') as wfile:
+        request = {'command': command, 'params': params}
+        if stream is not None:
+            request['stream'] = stream[0]
+        wfile.write(json.dumps(request).encode() + b'\n')
+        wfile.flush()
+        if stream is not None:
+            # Send the items while reading the output, so that neither side blocks on a full socket
+
+            def send(items):
+                try:
+                    for item in items:
+                        wfile.write(json.dumps(item).encode() + b'\n')
+                        wfile.flush()
+                    wfile.write(b'null\n')
+                    wfile.flush()
+                except (OSError, ValueError):  # The daemon ended the command before reading all the items
+                    pass
+
+            threading.Thread(target=send, args=(stream[1],), daemon=True).start()
+        for line in rfile:
+            message = json.loads(line.decode())
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+            else:
+                return message['exit']
+
+    return 1  # The daemon went away in the middle of the command
+
+
+# ----------------------------------------------------------------------
+# Statistics
+# ----------------------------------------------------------------------
+
+class Stats:
+    """Thread-safe counters of events such as cache hits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def report(self, file=sys.stderr):
+        for name, n in sorted(self.counts.items()):
+            print("{}: {}".format(name, round(n, 3) if isinstance(n, float) else n), file=file)
+
+
+_request = threading.local()  # Stats of the request served by the daemon in this thread, if any
+
+
+class RequestStats(Stats):
+    """Stats counting into those of the request served in the current thread, if set by use(), or else its own."""
+
+    def count(self, name, n=1):
+        stats = getattr(_request, 'stats', None)
+        if stats is not None:
+            stats.count(name, n)
+        else:
+            super().count(name, n)
+
+    @contextlib.contextmanager
+    def use(self, stats):
+        """Count into the Stats <stats> within the context, in this thread and the threads of a ContextExecutor."""
+
+        previous = getattr(_request, 'stats', None)
+        _request.stats = stats
+        try:
+            yield stats
+        finally:
+            _request.stats = previous
+
+
+STATS = RequestStats()  # Statistics shared by all the Azure face API calls
+
+
+class ContextExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor whose calls count their STATS as in the thread which submitted them.
+
+    So that the counts of a request served by the daemon, which starts its
+    own threads, are only those of the request.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        stats = getattr(_request, 'stats', None)
+
+        def call():
+            with STATS.use(stats):
+                return fn(*args, **kwargs)
+
+        return super().submit(call)
+
+
+class _Stage:
+    """Context timing a stage of the Profiler <profiler>."""
+
+    __slots__ = ('profiler', 'name', 'start', 'time')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.time = time.time()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.time)
+
+
+class _NoStage:
+    """Context of a stage when not profiling."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Profiler:
+    """Thread-safe timings of the stages of processing photos, such as reading them or calling the service.
+
+    Profiling is off until enable() is called, and stage() costs next to
+    nothing until then.  The seconds taken by each stage are counted in the
+    histogram buckets of PROFILE_BUCKETS, so that memory stays bounded however
+    many photos are processed.  If enable() is given a <trace> file, every
+    stage is also written to it as a complete event of the Chrome trace event
+    format.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stages = collections.OrderedDict()  # Stage name to [count, seconds, max seconds, bucket counts]
+        self._start = time.time()
+        self._trace = None
+        self._events = 0
+
+    def enable(self, trace=None):
+        """Start profiling, and writing the stages to the file <trace> if given."""
+
+        if trace is not None:
+            self._trace = open(trace, 'w')
+            self._trace.write('[\n')
+        self._start = time.time()
+        self.enabled = True
+
+    def stage(self, name):
+        """Return a context timing the stage <name>, e.g. with PROFILER.stage('read'): ..."""
+
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def add(self, name, seconds, start=None, tid=None):
+        """Count the stage <name> which took <seconds> from the time <start>, in the thread <tid>."""
+
+        if not self.enabled:
+            return
+
+        bucket = bisect.bisect_left(PROFILE_BUCKETS, seconds)
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = [0, 0.0, 0.0, [0] * (len(PROFILE_BUCKETS) + 1)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3][bucket] += 1
+
+            if self._trace is not None:
+                event = {
+                    'name': name,
+                    'ph': 'X',
+                    'ts': int(1e6 * (start if start is not None else time.time() - seconds)),
+                    'dur': int(1e6 * seconds),
+                    'pid': os.getpid(),
+                    'tid': tid if tid is not None else threading.get_ident(),
+                }
+                self._trace.write('{}{}'.format(',\n' if self._events else '', json.dumps(event)))
+                self._events += 1
+
+    @staticmethod
+    def _get_percentile(stats, q):
+
+        # Upper bound of the bucket of the <q>th percentile, or the max in the last bucket
+
+        count, _, longest, buckets = stats
+        rank = q / 100 * count
+        seen = 0
+        for bound, n in zip(PROFILE_BUCKETS, buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, longest)
+        return longest
+
+    def report(self, file=sys.stderr):
+        """Print the count, total, mean, percentiles and max of the seconds taken by each stage to <file>.
+
+        Stages run concurrently in several threads, so their totals may add
+        up to more than the wall time.
+        """
+
+        print("{:<14} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            'stage', 'count', 'total s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'), file=file)
+        with self._lock:
+            for name, stats in self._stages.items():
+                count, seconds, longest, _ = stats
+                print("{:<14} {:>8} {:>10.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                    name,
+                    count,
+                    seconds,
+                    1000 * seconds / count,
+                    *(1000 * self._get_percentile(stats, q) for q in (50, 95, 99)),
+                    1000 * longest), file=file)
+        print("{:<14} {:>19.3f}".format('wall', time.time() - self._start), file=file)
+
+    def close(self):
+        """Stop profiling and finish the trace file."""
+
+        self.enabled = False
+        if self._trace is not None:
+            self._trace.write('\n]\n')
+            self._trace.close()
+            self._trace = None
+
+
+PROFILER = Profiler()  # Timings of the stages of all the photos processed
+
+
+def start_profile(args):
+    """Start profiling according to command line <args>, and return whether profiling."""
+
+    if not (args.profile or args.profile_trace):
+        return False
+    PROFILER.enable(get_abspath(args.profile_trace) if args.profile_trace else None)
+    return True
+
+
+def stop_profile(args):
+    """Stop profiling according to command line <args>, reporting the timings if asked by --profile."""
+
+    if args.profile:
+        PROFILER.report()
+    PROFILER.close()
+
+
+# ----------------------------------------------------------------------
+# Throttling
+# ----------------------------------------------------------------------
+
+class RateLimiter:
+    """Token bucket allowing <rate> calls per second in bursts of up to <burst> calls.
+
+    One limiter can be shared by all threads and asyncio tasks calling the
+    service, so that together they stay within the quota.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before it can be used."""
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """Hold back all calls for <seconds>, e.g. as told by Retry-After."""
+
+        with self._lock:
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        import asyncio
+
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def get_error_status(error):
+    """Return (status code, headers) of the HTTP response of <error>, or (None, {}) if none."""
+
+    response = getattr(error, 'response', None)  # APIErrorException of the Azure SDK
+    if response is not None:
+        return getattr(response, 'status_code', None), getattr(response, 'headers', None) or {}
+
+    return getattr(error, 'status_code', None), getattr(error, 'headers', None) or {}  # FaceAPIError of aioface
+
+
+def is_transient_error(error):
+    """Return whether <error> is a timeout or connection failure worth retrying."""
+
+    import asyncio
+    from msrest.exceptions import ClientRequestError
+
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, asyncio.TimeoutError, ClientRequestError))
+
+
+class RetryPolicy:
+    """Retry calls to Azure face API which are throttled, fail in the service, or time out.
+
+    Throttled calls (429) wait as long as told by their Retry-After header,
+    during which the shared RateLimiter <limiter>, if any, holds back all
+    other calls too.  Calls failed by the service (5xx) or timed out back off
+    exponentially with full jitter.  A call is given up after <retries>
+    retries.  Throttled, retried and failed calls are counted in STATS,
+    except 404s which callers expect when checking if something exists.
+    """
+
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF, limiter=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+
+    def get_delay(self, error, attempt):
+        """Return the seconds to wait before retrying after <error> on <attempt>, or None if not to retry."""
+
+        if attempt >= self.retries:
+            return None
+
+        status, headers = get_error_status(error)
+        backoff = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if status == 429:
+            STATS.count('throttled calls')
+            try:
+                delay = float(headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                delay = backoff
+            if self.limiter is not None:
+                self.limiter.pause(delay)
+            return delay
+        elif status is not None and status >= 500:
+            return backoff
+        elif status is None and is_transient_error(error):
+            return backoff
+
+        return None
+
+    def call(self, func, *args, **kwargs):
+        """Call <func> with <args> and <kwargs>, rate limited and retried per the policy."""
+
+        streams = [(x, x.tell()) for x in list(args) + list(kwargs.values()) if hasattr(x, 'seek')]
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self.get_delay(e, attempt)
+                if delay is None:
+                    if get_error_status(e)[0] != 404:  # Probes for a group or list that may be missing
+                        STATS.count('failed calls')
+                    raise
+
+            STATS.count('retried calls')
+            time.sleep(delay)
+            attempt += 1
+            for stream, position in streams:  # Rewind uploaded photos
+                stream.seek(position)
+
+    async def call_async(self, func, *args, **kwargs):
+        """Await <func> with <args> and <kwargs>, rate limited and retried per the policy."""
+
+        import asyncio
+
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                await self.limiter.acquire_async()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self.get_delay(e, attempt)
+                if delay is None:
+                    if get_error_status(e)[0] != 404:  # Probes for a group or list that may be missing
+                        STATS.count('failed calls')
+                    raise
+
+            STATS.count('retried calls')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class ThrottledClient:
+    """Proxy of a FaceClient calling every operation, e.g. client.face.detect_with_stream(), per a RetryPolicy.
+
+    The retries of the SDK itself are turned off, so that the RetryPolicy is
+    the only layer retrying calls, and every call made passes its RateLimiter
+    and is counted.
+    """
+
+    def __init__(self, target, policy):
+        config = getattr(target, 'config', None)
+        if getattr(config, 'retry_policy', None) is not None:  # msrest retries timeouts and 5xx errors 3 times
+            config.retry_policy.retries = 0
+            config.retry_policy.policy.status_forcelist = []  # Errors are raised as APIErrorException with their status
+        self._target = target
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if callable(attr):
+            return functools.partial(self._policy.call, attr)
+        elif type(attr).__name__.endswith('Operations'):  # Operation groups such as client.face
+            return ThrottledClient(attr, self._policy)
+        return attr
+
+
+def get_retry_policy(args):
+    """Return the RetryPolicy according to command line <args>."""
+
+    return RetryPolicy(retries=args.retries, limiter=RateLimiter(args.tps) if args.tps else None)
+
+
+# ----------------------------------------------------------------------
+# Cache
+# ----------------------------------------------------------------------
+
+class DetectionCache:
+    """Persistent LRU cache of detection results keyed by the md5 digest of photos.
+
+    Results are kept in a SQLite database of at most <size> entries.  Results
+    with face IDs are only valid for <ttl> seconds, a margin before Azure face
+    API forgets the face IDs.
+    """
+
+    def __init__(self, path=CACHE_FILE, size=CACHE_SIZE, ttl=FACE_ID_TTL - FACE_ID_MARGIN):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS detection "
+                "(key TEXT PRIMARY KEY, faces TEXT, has_ids INTEGER, created REAL, used REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS detection_used ON detection (used)")
+            self._count, = self._conn.execute("SELECT COUNT(*) FROM detection").fetchone()
+
+    @staticmethod
+    def make_key(digest, **kwargs):
+        """Return the cache key of a photo with <digest> detected with <kwargs> of azface_detect()."""
+
+        attrs = kwargs.get('return_face_attributes') or []
+        attrs = sorted(str(getattr(attr, 'value', attr)) for attr in attrs)
+        return json.dumps([
+            digest,
+            attrs,
+            kwargs.get('return_face_id', True),
+            kwargs.get('return_face_landmarks', False),
+            str(kwargs.get('detection_model', 'detection_01')),
+            str(kwargs.get('recognition_model', 'recognition_01')),
+            kwargs.get('max_side'),
+            kwargs.get('max_bytes')] + (
+            [kwargs['tile_side'], kwargs.get('tile_overlap')] if kwargs.get('tile_side') else []))  # Tiled photos
+
+    def get(self, key):
+        """Return the faces cached under <key>, or None if missing or expired."""
+
+        from azure.cognitiveservices.vision.face.models import DetectedFace
+
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT faces, has_ids, created FROM detection WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] and now - row[2] > self.ttl:  # Face IDs expired
+                self._conn.execute("DELETE FROM detection WHERE key = ?", (key,))
+                self._count -= 1
+                row = None
+            if row is not None:
+                self._conn.execute("UPDATE detection SET used = ? WHERE key = ?", (now, key))
+
+        if row is None:
+            STATS.count('cache misses')
+            return None
+
+        STATS.count('cache hits')
+        return [DetectedFace.deserialize(face) for face in json.loads(row[0])]
+
+    def put(self, key, faces):
+        """Cache <faces> under <key>, evicting the least recently used results if full."""
+
+        now = time.time()
+        data = json.dumps([face.serialize(keep_readonly=True) for face in faces])
+        has_ids = any(face.face_id for face in faces)
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM detection WHERE key = ?", (key,)).fetchone() is None:
+                self._count += 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO detection VALUES (?, ?, ?, ?, ?)", (key, data, has_ids, now, now))
+            if self._count > self.size:
+                # Recount, since other processes may share the cache, and evict many results at once
+                self._count, = self._conn.execute("SELECT COUNT(*) FROM detection").fetchone()
+                if self._count > self.size:
+                    evicted = self._count - int(self.size * (1 - CACHE_EVICT))
+                    self._conn.execute(
+                        "DELETE FROM detection WHERE key IN (SELECT key FROM detection ORDER BY used LIMIT ?)",
+                        (evicted,))
+                    self._count -= evicted
+                    STATS.count('cache evictions', evicted)
+
+
+def get_detection_cache(args):
+    """Return the detection cache according to command line <args>, or None if disabled."""
+
+    return None if args.no_cache else DetectionCache(args.cache_file)
+
+
+# ----------------------------------------------------------------------
+# Index
+# ----------------------------------------------------------------------
+
+Rectangle = collections.namedtuple('Rectangle', ['left', 'top', 'width', 'height'])
+
+# A face enrolled into a LargeFaceList, which works with getbox() like DetectedFace
+
+IndexedFace = collections.namedtuple('IndexedFace', ['persisted_face_id', 'path', 'face_rectangle'])
+
+
+class FaceIndex:
+    """Local manifest of the faces enrolled into the LargeFaceList <face_list_id>.
+
+    The manifest maps the persisted face ID of each enrolled face to the
+    photo and the rectangle it was enrolled from, and records the md5 digest
+    of every enrolled photo, so that re-indexing only enrolls new photos.
+    """
+
+    def __init__(self, path=INDEX_FILE, face_list_id=FACE_LIST_ID):
+        self.face_list_id = face_list_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS photo "
+                "(face_list_id TEXT, digest TEXT, path TEXT, PRIMARY KEY (face_list_id, digest))")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS face "
+                "(face_list_id TEXT, persisted_face_id TEXT, path TEXT, "
+                "left INTEGER, top INTEGER, width INTEGER, height INTEGER, "
+                "PRIMARY KEY (face_list_id, persisted_face_id))")
+
+    def has_photo(self, digest):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM photo WHERE face_list_id = ? AND digest = ?", (self.face_list_id, digest)).fetchone()
+        return row is not None
+
+    def add_face(self, face):
+        """Record the IndexedFace <face> as soon as it is enrolled, before its photo is complete."""
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO face VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.face_list_id, face.persisted_face_id, face.path) + tuple(face.face_rectangle))
+
+    def remove_face(self, persisted_face_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM face WHERE face_list_id = ? AND persisted_face_id = ?",
+                (self.face_list_id, persisted_face_id))
+
+    def add_photo(self, digest, path, faces):
+        """Record the photo <path> of <digest> whose <faces> have been enrolled."""
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO face VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.face_list_id, face.persisted_face_id, path) + tuple(face.face_rectangle) for face in faces])
+            self._conn.execute("INSERT OR REPLACE INTO photo VALUES (?, ?, ?)", (self.face_list_id, digest, path))
+
+    def get_face(self, persisted_face_id):
+        """Return the IndexedFace of <persisted_face_id>, or None if unknown."""
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, left, top, width, height FROM face WHERE face_list_id = ? AND persisted_face_id = ?",
+                (self.face_list_id, persisted_face_id)).fetchone()
+        return None if row is None else IndexedFace(persisted_face_id, row[0], Rectangle(*row[1:]))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_training_state(status):
+    """Return the state of a TrainingStatus as a string such as 'running' or 'succeeded'."""
+
+    return str(getattr(status.status, 'value', status.status))
+
+
+def wait_for_training(get_status, interval=1, max_interval=30):
+    """Poll <get_status>() with exponential backoff until training finishes and return its TrainingStatus."""
+
+    while True:
+        status = get_status()
+        if get_training_state(status) in ('succeeded', 'failed'):
+            return status
+        time.sleep(interval)
+        interval = min(max_interval, interval * 2)
+
+
+# ----------------------------------------------------------------------
+# Person group
+# ----------------------------------------------------------------------
+
+class PersonGroup:
+    """Operations on the person group <person_group_id>, or on the large person group if <large> is True.
+
+    A large person group holds up to a million persons, a hundred times as
+    many as a person group, but takes longer to train.  Both are used the
+    same way through this adapter.
+    """
+
+    def __init__(self, client, person_group_id=PERSON_GROUP_ID, large=False):
+        self.client = client
+        self.person_group_id = person_group_id
+        self.large = large
+        self.groups = client.large_person_group if large else client.person_group
+        self.persons = client.large_person_group_person if large else client.person_group_person
+
+    @property
+    def key(self):
+        """Name of the group in local manifests, such as 'largepersongroup/azface'."""
+
+        return "{}/{}".format('largepersongroup' if self.large else 'persongroup', self.person_group_id)
+
+    def create_if_missing(self):
+        from azure.cognitiveservices.vision.face.models import APIErrorException
+
+        try:
+            self.groups.get(self.person_group_id)
+        except APIErrorException as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self.groups.create(self.person_group_id, name=self.person_group_id)
+
+    def list_persons(self):
+        """Return all the persons in the group, listed page by page."""
+
+        persons = []
+        start = None
+        while True:
+            page = self.persons.list(self.person_group_id, start=start, top=LIST_PAGE_SIZE)
+            persons.extend(page)
+            if len(page) < LIST_PAGE_SIZE:
+                return persons
+            start = page[-1].person_id
+
+    def create_person(self, name):
+        """Create the person <name> and return its ID."""
+
+        return self.persons.create(self.person_group_id, name=name).person_id
+
+    def add_face(self, person_id, image):
+        """Add the face in <image>, either a URL or a binary stream, to the person <person_id>.
+
+        Returns the persisted face ID of the face.
+        """
+
+        if isinstance(image, str):
+            face = self.persons.add_face_from_url(self.person_group_id, person_id, image)
+        else:
+            face = self.persons.add_face_from_stream(self.person_group_id, person_id, image)
+        return face.persisted_face_id
+
+    def train(self):
+        self.groups.train(self.person_group_id)
+        STATS.count('trainings')
+
+    def get_training_status(self):
+        """Return the TrainingStatus of the group, or None if it has never been trained."""
+
+        from azure.cognitiveservices.vision.face.models import APIErrorException
+
+        try:
+            return self.groups.get_training_status(self.person_group_id)
+        except APIErrorException as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            return None
+
+    def wait_for_training(self):
+        """Wait until the group is not being trained and return its TrainingStatus, or None if never trained."""
+
+        status = self.get_training_status()
+        if status is None or get_training_state(status) in ('succeeded', 'failed'):
+            return status
+        return wait_for_training(self.get_training_status)
+
+    def check_trained(self):
+        """Wait for any training of the group, and raise RuntimeError unless it is trained."""
+
+        status = self.wait_for_training()
+        if status is None:
+            raise RuntimeError("Person group {} is not trained, enroll persons first".format(self.person_group_id))
+        if get_training_state(status) == 'failed':
+            raise RuntimeError("Training of person group {} failed: {}".format(self.person_group_id, status.message))
+
+    def identify(self, face_ids, top=1, threshold=None):
+        """Identify the faces of <face_ids> among the persons of the group and return their IdentifyResult."""
+
+        from azure.cognitiveservices.vision.face.models import APIErrorException
+
+        group = {'large_person_group_id' if self.large else 'person_group_id': self.person_group_id}
+        try:
+            return self.client.face.identify(
+                face_ids, max_num_of_candidates_returned=top, confidence_threshold=threshold, **group)
+        except APIErrorException as e:
+            if get_error_status(e)[0] != 409:  # Being trained again since checked
+                raise
+        self.check_trained()
+        return self.client.face.identify(
+            face_ids, max_num_of_candidates_returned=top, confidence_threshold=threshold, **group)
+
+
+class TrainingScheduler:
+    """Background trainer of the PersonGroup <group>, coalescing its changes into as few trainings as possible.
+
+    Call changed() after each change of the group.  The group is trained at
+    most once every <interval> seconds, or only by flush() if <interval> is
+    None, with all the changes made until the training starts.  So the cost
+    of training stays bounded however many faces are added, while the group
+    is kept fairly up to date during long enrollments.
+    """
+
+    def __init__(self, group, interval=TRAIN_INTERVAL):
+        self.group = group
+        self.interval = interval
+        self.status = None  # TrainingStatus of the last training
+        self._changed = False
+        self._training = False
+        self._flushing = 0
+        self._closed = False
+        self._error = None
+        self._last = time.time()  # Start of the last training
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def training(self):
+        """Whether the group is being trained, when identify calls should not be made."""
+
+        return self._training
+
+    def changed(self):
+        with self._cond:
+            self._changed = True
+            self._cond.notify_all()
+
+    def _get_wait(self):
+
+        # Seconds to wait before the next training, or None to wait for changes
+
+        if not self._changed:
+            return 0 if self._closed else None
+        if self._flushing or self._closed:
+            return 0
+        if self.interval is None:
+            return None
+        return max(0, self._last + self.interval - time.time())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                wait = self._get_wait()
+                while wait != 0:
+                    self._cond.wait(wait)
+                    wait = self._get_wait()
+                if not self._changed:  # Closed
+                    return
+                self._changed = False
+                self._training = True
+                self._last = time.time()
+
+            try:
+                self.group.train()
+                status, error = self.group.wait_for_training(), None
+            except Exception as e:
+                status, error = None, e
+
+            with self._cond:
+                self._training = False
+                self.status, self._error = status, error
+                self._cond.notify_all()
+
+    def flush(self):
+        """Train the group with all changes so far, if not yet, and return its TrainingStatus.
+
+        Raises RuntimeError if the training failed.
+        """
+
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._changed or self._training:
+                    self._cond.wait()
+            finally:
+                self._flushing -= 1
+
+            if self._error is not None:
+                raise RuntimeError("Training of person group {} failed: {}".format(
+                    self.group.person_group_id, self._error)) from self._error
+            if self.status is not None and get_training_state(self.status) == 'failed':
+                raise RuntimeError("Training of person group {} failed: {}".format(
+                    self.group.person_group_id, self.status.message))
+            return self.status
+
+    def close(self):
+        """Flush and stop the scheduler."""
+
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+
+
 # ----------------------------------------------------------------------
 # Image
 # ----------------------------------------------------------------------
 
+class MemoryReader(io.RawIOBase):
+    """Seekable binary stream over the buffer <data>, such as the memoryview of an ImageHandle.
+
+    Unlike io.BytesIO, the buffer is not copied, only the chunks read from it.
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        self._view = memoryview(data)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+def get_image_size(data):
+    """Return (width, height) of the JPEG or PNG image <data> from its header, or None if unknown."""
+
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG segments up to the start of frame, which holds the size
+
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:  # Fill byte
+            i += 1
+        elif 0xd0 <= marker <= 0xd9 or marker == 0x01:  # Markers without a segment
+            i += 2
+        elif 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            return int.from_bytes(data[i + 7:i + 9], 'big'), int.from_bytes(data[i + 5:i + 7], 'big')
+        else:
+            i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+
+    return None
+
+
+class ImageHandle:
+    """Photo at <img_url>, read once to be uploaded, hashed and decoded without copies.
+
+    A local photo is memory-mapped and a photo at a URL is downloaded, on
+    first use of data, which is a memoryview of the encoded bytes.  They are
+    uploaded from open(), hashed for digest and decoded by decode() straight
+    from that memory.  The handle should be closed by close(), or by using it
+    as a context manager, to unmap the photo.
+    """
+
+    def __init__(self, img_url):
+        self.img_url = img_url
+        self._data = None
+        self._mmap = None
+        self._digest = None
+        self._images = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def data(self):
+        """The encoded bytes of the photo as a memoryview."""
+
+        import urllib.request
+
+        if self._data is None:
+            with PROFILER.stage('read'):
+                if is_url(self.img_url):
+                    with urllib.request.urlopen(self.img_url) as response:
+                        self._data = memoryview(response.read())
+                else:
+                    with open(self.img_url, 'rb') as file:
+                        try:
+                            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                            self._data = memoryview(self._mmap)
+                        except (ValueError, OSError):  # Empty files, pipes and devices cannot be mapped
+                            self._data = memoryview(file.read())
+        return self._data
+
+    @property
+    def digest(self):
+        """The md5 digest of the photo."""
+
+        if self._digest is None:
+            with PROFILER.stage('hash'):
+                self._digest = hashlib.md5(self.data).hexdigest()
+        return self._digest
+
+    def open(self):
+        """Return a new binary stream of the photo, to be uploaded."""
+
+        return MemoryReader(self.data)
+
+    def decode(self, max_side=None):
+        """Decode the photo as an OpenCV BGR image, or None if it cannot be decoded.
+
+        If <max_side> is given, the image is at most <max_side> pixels on the
+        longer side.  A JPEG photo is then decoded at a half, a quarter or an
+        eighth of its size straight away, which is faster and takes less
+        memory.  Returns (image, scale) where scale is the size of the image
+        relative to the photo.  Images are kept for later calls.
+        """
+
+        import cv2 as cv
+        import numpy as np
+
+        if max_side in self._images:
+            return self._images[max_side]
+
+        flags = cv.IMREAD_COLOR
+        size = get_image_size(self.data) if max_side else None
+        if size is not None:
+            for factor, reduced in ((8, cv.IMREAD_REDUCED_COLOR_8),
+                                    (4, cv.IMREAD_REDUCED_COLOR_4),
+                                    (2, cv.IMREAD_REDUCED_COLOR_2)):
+                if max(size) >= factor * max_side:
+                    flags = reduced
+                    break
+
+        with PROFILER.stage('decode'):
+            image = cv.imdecode(np.frombuffer(self.data, dtype="uint8"), flags) if len(self.data) else None
+
+        scale = 1.0
+        if image is not None:
+            height, width = image.shape[:2]
+            if size is not None:
+                scale = width / size[0]
+            if max_side and max(height, width) > max_side:
+                resize = max_side / max(height, width)
+                image = cv.resize(image, None, fx=resize, fy=resize, interpolation=cv.INTER_AREA)
+                scale *= resize
+
+        self._images[max_side] = image, scale
+        return image, scale
+
+    def close(self):
+        self._images = {}
+        if self._data is not None:
+            self._data.release()
+            self._data = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # Still exported by a stream being read, so left to be unmapped when released
+                pass
+            self._mmap = None
+
+
 def read_cv_image_from(url):
-    """Read an image from url or file as grayscale opencv image.
+    """Read an image from url or file as an OpenCV BGR image.
 
     **Note**: OpenCV return the image as numpy array, which can also directly
     be used by other Python image libraries.  However, the color space in
     OpenCV is BGR instead of the popular RGB.
     """
 
-    return toolz.pipe(
-        url,
-        urllib.request.urlopen if is_url(url) else lambda x: open(x, 'rb'),
-        lambda x: x.read(),
-        bytearray,
-        lambda x: np.asarray(x, dtype="uint8"),
-        lambda x: cv.imdecode(x, cv.IMREAD_COLOR))
+    with ImageHandle(url) as handle:
+        return handle.decode()[0]
+
+
+def decode_cv_image(data):
+    """Decode the encoded image <data>, such as the bytes kept by ingest_img(), as an OpenCV BGR image."""
+
+    import cv2 as cv
+    import numpy as np
+
+    with PROFILER.stage('decode'):
+        return cv.imdecode(np.frombuffer(data, dtype="uint8"), cv.IMREAD_COLOR)
+
+
+def shrink_image(data, max_side=None, max_bytes=None, min_face=UPLOAD_MIN_FACE, quality=UPLOAD_QUALITY):
+    """Downscale and re-encode the encoded image <data> to save upload bandwidth.
+
+    The image is resized so that its longer side is at most <max_side> pixels,
+    and never more than MAX_IMAGE_SIDE, then re-encoded as JPEG, lowering the
+    quality and then the size until it takes at most <max_bytes> bytes.  When
+    the image is scaled below MIN_FACE_SIZE / <min_face>, faces of <min_face>
+    pixels in the original image may no longer be detected, which is warned
+    about once and counted.
+
+    Returns (data, scale) where scale is the size of the result relative to the
+    original image.  The original <data> is returned if it needs no shrinking,
+    or if OpenCV cannot decode it, so that the service reports the bad image.
+    """
+
+    import cv2 as cv
+
+    max_side = min(max_side or MAX_IMAGE_SIDE, MAX_IMAGE_SIDE)
+    size = get_image_size(data)
+    if size and max(size) <= max_side and (not max_bytes or len(data) <= max_bytes):
+        return data, 1.0
+
+    image = decode_cv_image(data)
+    if image is None:  # Truncated, or in a format OpenCV does not support
+        return data, 1.0
+    height, width = image.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+
+    if scale == 1.0 and (not max_bytes or len(data) <= max_bytes):
+        return data, 1.0
+
+    while True:
+        if scale == 1.0:
+            resized = image
+        else:
+            size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+            resized = cv.resize(image, size, interpolation=cv.INTER_AREA)
+
+        for q in (quality, quality - 15, quality - 30):
+            _, encoded = cv.imencode('.jpg', resized, [cv.IMWRITE_JPEG_QUALITY, q])
+            if not max_bytes or len(encoded) <= max_bytes:
+                break
+
+        if not max_bytes or len(encoded) <= max_bytes or max(resized.shape[:2]) <= MIN_FACE_SIZE:
+            break
+
+        scale *= 0.75
+
+    if scale < MIN_FACE_SIZE / min_face:
+        STATS.count('photos shrunk below detectable faces')
+        warnings.warn(
+            "Photos are shrunk so much that faces smaller than {} pixels may not be detected; "
+            "raise --max-side or --max-bytes to keep them".format(min_face), stacklevel=2)
+
+    if max_bytes and len(encoded) > max_bytes:
+        STATS.count('photos over max bytes')
+
+    if scale == 1.0 and len(encoded) >= len(data):  # Re-encoding did not help
+        return data, 1.0
+
+    return encoded.tobytes(), scale
 
 
 def convert_cv2matplot(*images):
@@ -183,6 +1711,8 @@ def convert_cv2matplot(*images):
     Because OpenCV and Matplotlib use different color spaces.
     """
 
+    import cv2 as cv
+
     if len(images) > 0:
         res = []
         for image in images:
@@ -229,6 +1759,9 @@ def plot_side_by_side_comparison(
         rightdescription=None):
     """Plot two images side by side."""
 
+    import matplotlib.gridspec as gridspec
+    import matplotlib.pyplot as plt
+
     # Setup canvas
 
     plt.rcParams.update({'figure.autolayout': True})
@@ -264,6 +1797,8 @@ def show_image(url, show=True):
 def display(img, frombgr=False, text=None):
     """Display <img> array."""
 
+    import matplotlib.pyplot as plt
+
     if frombgr:
         img = convert_cv2matplot(img)
     height, _, _ = img.shape
@@ -279,6 +1814,441 @@ def display(img, frombgr=False, text=None):
     plt.show()
 
 
+# ----------------------------------------------------------------------
+# Render
+# ----------------------------------------------------------------------
+
+def render_photos(photos, path, quality=RENDER_QUALITY):
+    """Mark faces in photos and save them side by side to the image file <path>, without displaying them.
+
+    <photos> is a list of (img_url, marks), where marks is a list of (box,
+    text) to be drawn by mark_face().  Photos are scaled to the height of
+    the first one.  The format of the file, such as JPEG or PNG, follows the
+    extension of <path>.
+    """
+
+    import cv2 as cv
+
+    images = []
+    for img_url, marks in photos:
+        image = read_cv_image_from(img_url)
+        if image is None:
+            raise IOError("Cannot decode {}".format(img_url))
+
+        height, width = image.shape[:2]
+        scale = images[0].shape[0] / height if images else 1.0
+        if scale != 1.0:  # Scaled before marking, so that marks are of the same size in all photos
+            size = (max(1, int(round(width * scale))), images[0].shape[0])
+            image = cv.resize(image, size, interpolation=cv.INTER_AREA)
+
+        for box, text in marks:
+            mark_face(image, tuple(int(round(x * scale)) for x in box), text=text)
+        images.append(image)
+
+    image = images[0] if len(images) == 1 else cv.hconcat(images)
+    if not cv.imwrite(path, image, [cv.IMWRITE_JPEG_QUALITY, quality]):
+        raise IOError("Cannot write {}".format(path))
+
+
+def render_photos_timed(photos, path, quality=RENDER_QUALITY):
+    """Render <photos> into <path> by render_photos() and return (start time, seconds, process ID) of the rendering.
+
+    Used by Renderer, whose processes do not share the PROFILER.
+    """
+
+    start = time.time()
+    clock = time.perf_counter()
+    render_photos(photos, path, quality)
+    return start, time.perf_counter() - clock, os.getpid()
+
+
+def get_render_name(*img_urls, ext='.jpg'):
+    """Return the file name of the rendering of <img_urls>, named after the photos and unique to them."""
+
+    names = [os.path.splitext(os.path.basename(img_url.split('?')[0]))[0] for img_url in img_urls]
+    digest = hashlib.md5('\n'.join(img_urls).encode()).hexdigest()[:8]
+    return "{}-{}{}".format('-'.join(names), digest, ext)
+
+
+def get_detection_marks(faces):
+    """Return the marks of <faces> for render_photos(), labelled by their numbers."""
+
+    return [(getbox(face), str(i)) for i, face in enumerate(faces)]
+
+
+def get_similar_marks(target_faces, candidate_faces, matches):
+    """Return the marks of <target_faces> and <candidate_faces> for render_photos().
+
+    Target faces are labelled by their numbers, and candidate faces by the
+    numbers of the target faces they match in <matches>, or '?'.
+    """
+
+    labels = {face.face_id: str(i) for i, face in enumerate(target_faces)}
+    target_marks = [(getbox(face), labels[face.face_id]) for face in target_faces]
+    candidate_marks = [
+        (getbox(face), labels[matches[face.face_id][0].face_id] if face.face_id in matches else '?')
+        for face in candidate_faces]
+    return target_marks, candidate_marks
+
+
+class Renderer:
+    """Pool of <workers> processes rendering marked photos into the folder <folder>.
+
+    Photos are rendered by render_photos() as files of the extension <ext>,
+    in the background of the calls to the service.  Only a bounded number of
+    renderings are queued, so that they keep up with an endless stream of
+    photos.  A rendering that fails is reported on <err>, stderr by default.
+    """
+
+    def __init__(self, folder, workers=RENDER_WORKERS, ext='.jpg', err=None):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.workers = workers
+        self.ext = ext
+        self.err = err
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self._pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, photos, *img_urls):
+        """Render <photos> as for render_photos() into a file named after <img_urls>."""
+
+        path = os.path.join(self.folder, get_render_name(*img_urls, ext=self.ext))
+        self._pending.append((path, self._executor.submit(render_photos_timed, photos, path)))
+        while len(self._pending) >= 2 * self.workers:
+            self._wait()
+
+    def _wait(self):
+        path, future = self._pending.popleft()
+        try:
+            start, seconds, pid = future.result()
+            PROFILER.add('render', seconds, start, tid=pid)
+            STATS.count('rendered photos')
+        except Exception as e:
+            print("Failed to render {}: {}".format(path, e), file=self.err or sys.stderr)
+
+    def close(self):
+        """Wait for the renderings queued and stop the processes."""
+
+        while self._pending:
+            self._wait()
+        self._executor.shutdown()
+
+
+def get_renderer(args):
+    """Return the renderer according to command line <args>, or None if not rendering."""
+
+    if not args.render:
+        return None
+    return Renderer(get_abspath(args.render), args.render_workers, '.' + args.render_format)
+
+
+# ----------------------------------------------------------------------
+# Prefilter
+# ----------------------------------------------------------------------
+
+class FacePrefilter:
+    """Local screen of photos for faces by an OpenCV cascade classifier.
+
+    Photos where the classifier finds no face of confidence at least
+    <threshold> are deemed to have no face, and need not be sent to Azure
+    face API.  The classifier misses some faces which the service finds, so
+    <threshold> trades the calls saved against the faces missed, which can
+    be measured by bench/prefilter.py.  <cascade> is the file of the
+    classifier, by default PREFILTER_CASCADE from OpenCV.
+    """
+
+    def __init__(self, threshold=PREFILTER_THRESHOLD, cascade=None, max_side=PREFILTER_SIDE):
+        self.threshold = threshold
+        self.cascade = cascade
+        self.max_side = max_side
+        self._local = threading.local()  # Classifiers are not thread-safe, so each thread has its own
+
+    def _get_classifier(self):
+        import cv2 as cv
+
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            path = self.cascade or os.path.join(cv.data.haarcascades, PREFILTER_CASCADE)
+            classifier = cv.CascadeClassifier(path)
+            if classifier.empty():
+                raise IOError("Cannot load the cascade classifier {}".format(path))
+            self._local.classifier = classifier
+        return classifier
+
+    def get_confidence(self, data):
+        """Return the confidence of the most likely face in the encoded image <data>, or None if none found."""
+
+        import cv2 as cv
+
+        image = decode_cv_image(data)
+        if image is None:  # Left for the service to report
+            return float('inf')
+
+        height, width = image.shape[:2]
+        if self.max_side and max(height, width) > self.max_side:
+            scale = self.max_side / max(height, width)
+            image = cv.resize(image, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+
+        gray = cv.equalizeHist(cv.cvtColor(image, cv.COLOR_BGR2GRAY))
+        _, _, weights = self._get_classifier().detectMultiScale3(
+            gray, scaleFactor=1.1, minNeighbors=1, outputRejectLevels=True)
+
+        return float(max(weights)) if len(weights) else None
+
+    def has_face(self, data):
+        """Return whether the encoded image <data> may have a face and should be sent to the service."""
+
+        start = time.time()
+        with PROFILER.stage('prefilter'):
+            confidence = self.get_confidence(data)
+        STATS.count('prefilter seconds', time.time() - start)
+
+        if confidence is None or confidence < self.threshold:
+            STATS.count('prefilter skipped calls')
+            return False
+
+        STATS.count('prefilter passed calls')
+        return True
+
+
+def get_prefilter(args):
+    """Return the face prefilter according to command line <args>, or None if disabled."""
+
+    return FacePrefilter(args.prefilter_threshold) if args.prefilter else None
+
+
+# ----------------------------------------------------------------------
+# Near-duplicates
+# ----------------------------------------------------------------------
+
+def get_dhash(image):
+    """Return the 64-bit difference hash of the OpenCV BGR <image> as an int.
+
+    Each bit tells whether a pixel of the image, shrunk to 9 x 8 gray
+    pixels, is brighter than its left neighbour, so that near-duplicates,
+    such as burst shots or copies resized or re-encoded, differ in a few
+    bits at most.
+    """
+
+    import cv2 as cv
+    import numpy as np
+
+    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    small = cv.resize(gray, (9, 8), interpolation=cv.INTER_AREA).astype(np.int16)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+class DuplicateIndex:
+    """In-memory index of the photos detected by their dHash, to reuse their faces for near-duplicates.
+
+    A photo whose dHash differs from that of a photo already detected by at
+    most <distance> bits is a near-duplicate, and gets the faces of that
+    photo, scaled to its own size, without calling the service.  Photos are
+    looked up concurrently, and a near-duplicate of a photo still being
+    detected waits for its faces.  The faces of a near-duplicate share the
+    face IDs of the original.
+    """
+
+    def __init__(self, distance=DEDUP_DISTANCE):
+        import numpy as np
+
+        self.distance = distance
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._photos = []  # (future of faces, width, height) of each hash
+        self._bits = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)  # Set bits of each byte
+
+    def find(self, dhash, width, height):
+        """Return (future, width, height) of the photo nearest <dhash>, and whether it is a new photo.
+
+        If no photo is near enough, the photo of <dhash> and size <width> x
+        <height> is added as new, and the future of its faces is to be set by
+        the caller.
+        """
+
+        import numpy as np
+
+        with self._lock:
+            count = len(self._photos)
+            if count:
+                xor = np.bitwise_xor(self._hashes[:count], np.uint64(dhash))
+                distances = self._bits[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+                nearest = int(np.argmin(distances))
+                if distances[nearest] <= self.distance:
+                    return self._photos[nearest], False
+
+            if count == len(self._hashes):
+                self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+            self._hashes[count] = dhash
+            self._photos.append((concurrent.futures.Future(), width, height))
+            return self._photos[count], True
+
+    def detect(self, handle, detect):
+        """Return the faces of the ImageHandle <handle>, from a near-duplicate or else by calling <detect>()."""
+
+        from azure.cognitiveservices.vision.face.models import DetectedFace
+
+        with PROFILER.stage('dedup'):
+            image, scale = handle.decode(DHASH_SIDE)
+            if image is None:  # Left for the service to report
+                return detect()
+            height, width = (int(round(x / scale)) for x in image.shape[:2])
+            (future, original_width, original_height), new = self.find(get_dhash(image), width, height)
+
+        if new:
+            try:
+                faces = detect()
+            except Exception:
+                future.set_result(None)  # Near-duplicates are detected on their own
+                raise
+            future.set_result(faces)
+            return faces
+
+        faces = future.result()
+        if faces is None:
+            return detect()
+
+        STATS.count('near-duplicate photos')
+        faces = [DetectedFace.deserialize(face.serialize(keep_readonly=True)) for face in faces]
+        if (width, height) == (original_width, original_height):
+            return faces
+        return scale_faces(faces, width / original_width, height / original_height)
+
+
+def get_duplicate_index(args):
+    """Return the near-duplicate index according to command line <args>, or None if disabled."""
+
+    return DuplicateIndex(args.dedup_distance) if args.dedup else None
+
+
+# ----------------------------------------------------------------------
+# Video
+# ----------------------------------------------------------------------
+
+def open_video(source):
+    """Open <source>, a camera number, a video file or a stream URL, as an OpenCV VideoCapture."""
+
+    import cv2 as cv
+
+    capture = cv.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise IOError("Cannot open video {}".format(source))
+    return capture
+
+
+def create_tracker():
+    """Return a new OpenCV object tracker, from whichever tracker API this OpenCV provides."""
+
+    import cv2 as cv
+
+    for factory in ('TrackerKCF_create', 'legacy.TrackerKCF_create', 'TrackerMIL_create'):
+        module = cv
+        for name in factory.split('.'):
+            module = getattr(module, name, None)
+        if module is not None:
+            return module()
+
+    raise RuntimeError("No object tracker available in OpenCV {}".format(cv.__version__))
+
+
+def get_thumbnail(frame, size=64):
+    """Return a small grayscale copy of <frame> for cheap comparison of frames."""
+
+    import cv2 as cv
+
+    return cv.resize(cv.cvtColor(frame, cv.COLOR_BGR2GRAY), (size, size), interpolation=cv.INTER_AREA)
+
+
+def get_scene_change(thumbnail, other):
+    """Return the mean absolute change of pixels between two thumbnails, from 0 to 1."""
+
+    import cv2 as cv
+
+    return cv.absdiff(thumbnail, other).mean() / 255
+
+
+def azface_track(client, capture, threshold=SCENE_CHANGE, interval=KEYFRAME_INTERVAL, **kwargs):
+    """Detect faces in the frames of the OpenCV VideoCapture <capture>, calling the service sparingly.
+
+    A frame is sent to the service only when it differs from the last frame
+    sent by more than <threshold>, or <interval> frames have passed.  The
+    service is called in the background, one frame at a time, while the
+    faces found last are followed from frame to frame by OpenCV trackers, so
+    the video is never held up by the service.  <kwargs> are passed to
+    azface_detect_data().
+
+    Yield (frame number, frame, faces) for every frame, where the rectangles
+    of faces are those in the frame.  Each frame has its own copies of the
+    faces.  If a key frame fails, the faces are tracked on until the next.
+    """
+
+    import cv2 as cv
+    from azure.cognitiveservices.vision.face.models import FaceRectangle
+
+    executor = ContextExecutor(max_workers=1)
+    future = None  # Detection in flight
+    key_frame, key_number, key_thumbnail = None, -interval, None
+    tracked = []  # (face, tracker)
+
+    try:
+        number = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+
+            # Send a key frame to the service if the scene changed or it is time to
+
+            thumbnail = get_thumbnail(frame)
+            if future is None and (
+                    number - key_number >= interval or get_scene_change(thumbnail, key_thumbnail) > threshold):
+                _, data = cv.imencode('.jpg', frame)
+                future = executor.submit(azface_detect_data, client, data.tobytes(), **kwargs)
+                key_frame, key_number, key_thumbnail = frame.copy(), number, thumbnail  # Frames yielded are marked
+                STATS.count('detected frames')
+
+            # Track the faces detected in the key frame, or those tracked in the last frame
+
+            if future is not None and future.done():
+                try:
+                    detected = future.result()
+                except Exception as e:  # Keep tracking the faces of the last key frame
+                    print("Failed to detect faces in frame {}: {}".format(key_number, e), file=sys.stderr)
+                    STATS.count('failed frames')
+                    detected = None
+                future = None
+                if detected is not None:
+                    tracked = []
+                    for face in detected:
+                        rect = face.face_rectangle
+                        tracker = create_tracker()
+                        tracker.init(key_frame, (rect.left, rect.top, rect.width, rect.height))
+                        tracked.append((face, tracker))
+
+            kept, faces = [], []
+            for face, tracker in tracked:
+                ok, (left, top, width, height) = tracker.update(frame)
+                if ok:  # Faces lost by their trackers are dropped until the next detection
+                    face = copy.copy(face)  # Faces yielded for earlier frames keep their rectangles
+                    face.face_rectangle = FaceRectangle(
+                        left=int(left), top=int(top), width=int(width), height=int(height))
+                    kept.append((face, tracker))
+                    faces.append(face)
+            tracked = kept
+
+            STATS.count('frames')
+            yield number, frame, faces
+            number += 1
+    finally:
+        executor.shutdown(wait=False)
+
+
 # ----------------------------------------------------------------------
 # Face
 # ----------------------------------------------------------------------
@@ -288,6 +2258,36 @@ def get_face_api_key_endpoint(subscription_key, endpoint):
     return subscription_key, endpoint
 
 
+def get_key_endpoint(args):
+    """Return the subscription key and endpoint in command line <args>, requesting them from user if not given."""
+
+    import readline  # Don't remove !! For prompt of input() to take effect
+
+    subscription_key, endpoint = args.key, args.endpoint
+    if not subscription_key or not endpoint:
+        subscription_key, endpoint = get_face_api_key_endpoint(*azkey(args.key_file, SERVICE, verbose=False))
+
+    return subscription_key, endpoint
+
+
+def get_face_client(args):
+    """Return a FaceClient according to command line <args>, rate limited and retried by a RetryPolicy."""
+
+    # Imported here, since the Azure SDK is slow to import and not needed when the daemon serves a command
+
+    from packaging import version
+    import azure.cognitiveservices.vision.face as faceAPI
+    if version.parse(faceAPI.__version__) <= version.parse('0.3.0'):
+        from azure.cognitiveservices.vision.face.face_client import FaceClient  # The main interface to access Azure face API
+    else:
+        from azure.cognitiveservices.vision.face import FaceClient
+    from msrest.authentication import CognitiveServicesCredentials  # To hold the subscription key
+
+    subscription_key, endpoint = get_key_endpoint(args)
+    credentials = CognitiveServicesCredentials(subscription_key)  # Set credentials
+    return ThrottledClient(FaceClient(endpoint, credentials), get_retry_policy(args))  # Setup Azure face API client
+
+
 def getbox(face):
     """Convert width and height in face to a point in a rectangle"""
 
@@ -299,11 +2299,58 @@ def getbox(face):
     return top, right, bottom, left
 
 
+def scale_box(box, scale):
+    """Scale the <box> of getbox() by <scale>, such as that of an image decoded by ImageHandle.decode()."""
+
+    return box if scale == 1.0 else tuple(int(round(x * scale)) for x in box)
+
+
 def getbox_points(face):
     top, right, bottom, left = getbox(face)
     return left, top, left, bottom, right, bottom, right, top
 
 
+def scale_faces(faces, factor, factor_y=None):
+    """Scale the rectangles and landmarks of <faces> in place by <factor>.
+
+    Used to map faces detected in a resized photo back to the original photo.
+    If <factor_y> is given, vertical coordinates are scaled by it instead.
+    """
+
+    factor_y = factor if factor_y is None else factor_y
+    for face in faces:
+        rect = face.face_rectangle
+        rect.left, rect.width = (int(round(x * factor)) for x in (rect.left, rect.width))
+        rect.top, rect.height = (int(round(y * factor_y)) for y in (rect.top, rect.height))
+        if face.face_landmarks:
+            for point in vars(face.face_landmarks).values():
+                if hasattr(point, 'x') and hasattr(point, 'y'):
+                    point.x *= factor
+                    point.y *= factor_y
+
+    return faces
+
+
+def shift_faces(faces, left, top):
+    """Move the rectangles and landmarks of <faces> in place by <left> and <top> pixels.
+
+    Used to map faces detected in a part of a photo, such as a tile of a
+    mosaic, to the photo.
+    """
+
+    for face in faces:
+        rect = face.face_rectangle
+        rect.left += left
+        rect.top += top
+        if face.face_landmarks:
+            for point in vars(face.face_landmarks).values():
+                if hasattr(point, 'x') and hasattr(point, 'y'):
+                    point.x += left
+                    point.y += top
+
+    return faces
+
+
 def mark_face(image, face, text=None):
     """Mark the <faces> in <image>.
 
@@ -313,6 +2360,8 @@ def mark_face(image, face, text=None):
         text: Text would be displayed above the face box.
     """
 
+    import cv2 as cv
+
     # Draw a rectangle around the faces
 
     (textwidth, textheight), baseline = cv.getTextSize(text, TEXT_FONT, TEXT_SIZE, LINE_WIDTH)
@@ -357,12 +2406,13 @@ def interpret_occlusion(occlusion):
 
 
 def show_detection_results(img_url, faces):
-    bgr = read_cv_image_from(img_url)
+    with ImageHandle(img_url) as handle:
+        bgr, scale = handle.decode(DISPLAY_SIDE)
     description = ''
     if faces:
         labels = {face.face_id: str(i) for i, face in enumerate(faces)}
         for face in faces:
-            mark_face(bgr, getbox(face), text=labels[face.face_id])
+            mark_face(bgr, scale_box(getbox(face), scale), text=labels[face.face_id])
             attrs = face.face_attributes
             description += "Face No. {}: {} years-old, {}, {}, {}, {}\n".format(
                 labels[face.face_id],
@@ -379,7 +2429,9 @@ def show_detection_results(img_url, faces):
     display(bgr, frombgr=True, text=description)
 
 
-def print_detection_results(faces):
+def print_detection_results(faces, tag=None, file=None):
+    """Print one line per face in <faces> to <file>, prefixed with <tag> if any, such as the photo path."""
+
     if faces:
         for face in faces:
             coordinates = " ".join([str(x) for x in getbox_points(face)])
@@ -391,43 +2443,804 @@ def print_detection_results(faces):
                 interpret_glasses(attrs.glasses),
                 interpret_emotion(attrs.emotion),
                 interpret_occlusion(attrs.occlusion))
-            print(description)
-
+            if tag is not None:
+                description = "{},{}".format(tag, description)
+            print(description, file=file)
+
+
+def azface_detect(
+        client,
+        img_url,
+        cache=None,
+        prefilter=None,
+        max_side=None,
+        max_bytes=None,
+        dedup=None,
+        tile_side=None,
+        tile_overlap=TILE_OVERLAP,
+        manifest=None,
+        **kwargs):
+    """Detect faces using Azure face API.
+
+    If <cache> is given, results of local photos are looked up in and saved to
+    the DetectionCache <cache> by the md5 digest of the photo.
+
+    If <prefilter> is given, the photo is first screened by the FacePrefilter
+    <prefilter>, and no faces are returned without calling the service if it
+    finds none.
+
+    If <max_side> or <max_bytes> is given, the photo is shrunk by
+    shrink_image() before upload and the faces are mapped back to the
+    coordinates of the original photo.
+
+    If <dedup> is given, the photo gets the faces of a near-duplicate found in
+    the DuplicateIndex <dedup> instead, if any.
+
+    If <tile_side> is given and the photo is larger, it is detected tile by
+    tile by azface_detect_tiled(), with <tile_overlap>, to find small faces.
+
+    If <manifest> is given, local photos detected are recorded in the
+    FileManifest <manifest> by the digest of the photo read for upload.
+    """
 
-def azface_detect(client, img_url, **kwargs):
-    """Detect faces using Azure face API."""
+    if is_url(img_url):
+        cache = None  # Photos at URLs may change
+        manifest = None  # Nor are they recorded
+
+    if (cache is not None or prefilter is not None or max_side or max_bytes or dedup is not None or tile_side
+            or manifest is not None):
+        with ImageHandle(img_url) as handle:
+            def detect():
+                return azface_detect_data(
+                    client,
+                    handle.data,
+                    cache=cache,
+                    digest=handle.digest if cache is not None else None,
+                    prefilter=prefilter,
+                    max_side=max_side,
+                    max_bytes=max_bytes,
+                    tile_side=tile_side,
+                    tile_overlap=tile_overlap,
+                    **kwargs)
+
+            faces = dedup.detect(handle, detect) if dedup is not None else detect()
+            if manifest is not None:
+                manifest.add(img_url, handle.digest)
+            return faces
 
     if is_url(img_url):  # Photo from URL
         # For return_face_attributes, it can be a FaceAttributeType, or a list of string
-        faces = client.face.detect_with_url(img_url, **kwargs)
+        with PROFILER.stage('detect'):
+            faces = client.face.detect_with_url(img_url, **kwargs)
     else:  # Photo from a file
-        with open(img_url, 'rb') as file:
+        with open(img_url, 'rb') as file, PROFILER.stage('detect'):  # Reading is part of the upload
             # For face attributes, it can be a FaceAttributeType, or a list of string
             faces = client.face.detect_with_stream(file, **kwargs)
 
     return faces
 
 
-def azface_similar(client, target_faces, candidate_faces):
+def azface_detect_data(
+        client,
+        data,
+        cache=None,
+        digest=None,
+        prefilter=None,
+        max_side=None,
+        max_bytes=None,
+        tile_side=None,
+        tile_overlap=TILE_OVERLAP,
+        **kwargs):
+    """Detect faces in the encoded image <data>, such as the bytes kept by ingest_img() or those of an ImageHandle.
+
+    If <cache> is given, results are looked up in and saved to it by <digest>,
+    the md5 digest of <data>, which is computed if not given.  <prefilter>,
+    <max_side>, <max_bytes>, <tile_side> and <tile_overlap> are as in
+    azface_detect().
+    """
+
+    size = get_image_size(data) if tile_side else None
+    if not size or max(size) <= tile_side:
+        tile_side = None
+
+    if cache is not None:
+        if digest is None:
+            with PROFILER.stage('hash'):
+                digest = hashlib.md5(data).hexdigest()
+        key = cache.make_key(
+            digest, max_side=max_side, max_bytes=max_bytes, tile_side=tile_side, tile_overlap=tile_overlap, **kwargs)
+        with PROFILER.stage('cache'):
+            faces = cache.get(key)
+        if faces is None:
+            if prefilter is not None and not prefilter.has_face(data):
+                return []  # Not cached, so that skipped photos are screened again, perhaps with another threshold
+            faces = azface_detect_data(
+                client,
+                data,
+                max_side=max_side,
+                max_bytes=max_bytes,
+                tile_side=tile_side,
+                tile_overlap=tile_overlap,
+                **kwargs)
+            with PROFILER.stage('cache'):
+                cache.put(key, faces)
+        return faces
+
+    if prefilter is not None and not prefilter.has_face(data):
+        return []
+
+    if tile_side:
+        return azface_detect_tiled(
+            client, data, side=tile_side, overlap=tile_overlap, max_side=max_side, max_bytes=max_bytes, **kwargs)
+
+    scale = 1.0
+    if max_side or max_bytes:
+        start = time.time()
+        with PROFILER.stage('shrink'):
+            upload, scale = shrink_image(data, max_side, max_bytes)
+        STATS.count('shrink seconds', time.time() - start)
+        if upload is not data:
+            STATS.count('shrunk photos')
+            STATS.count('upload bytes saved', len(data) - len(upload))
+        data = upload
+
+    start = time.time()
+    with PROFILER.stage('detect'):
+        faces = client.face.detect_with_stream(MemoryReader(data), **kwargs)
+    STATS.count('upload seconds', time.time() - start)
+    STATS.count('upload bytes', len(data))
+
+    return scale_faces(faces, 1 / scale) if scale != 1.0 else faces
+
+
+def get_tile_offsets(length, side, overlap):
+    """Return the offsets of tiles of <side> pixels covering <length> pixels, overlapping by <overlap> at least."""
+
+    if length <= side:
+        return [0]
+
+    count = math.ceil((length - overlap) / (side - overlap))
+    return [int(round(i * (length - side) / (count - 1))) for i in range(count)]
+
+
+def suppress_faces(faces, threshold=TILE_IOU):
+    """Return <faces> without the duplicates, found in different tiles of a photo, by non-maximum suppression.
+
+    Of the faces whose rectangles overlap by an intersection over union
+    above <threshold>, only the largest is kept, since the others are cut by
+    the edges of their tiles.  Faces are returned by decreasing size, as
+    the service returns them.
+    """
+
+    import numpy as np
+
+    if len(faces) < 2:
+        return faces
+
+    rects = np.array([[x.face_rectangle.left, x.face_rectangle.top, x.face_rectangle.width, x.face_rectangle.height]
+                      for x in faces], dtype=float)
+    lefts, tops = rects[:, 0], rects[:, 1]
+    rights, bottoms = lefts + rects[:, 2], tops + rects[:, 3]
+    areas = rects[:, 2] * rects[:, 3]
+
+    keep = []
+    order = np.argsort(-areas, kind='mergesort')  # Stable, so that equal faces keep their order
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        widths = np.clip(np.minimum(rights[i], rights[rest]) - np.maximum(lefts[i], lefts[rest]), 0, None)
+        heights = np.clip(np.minimum(bottoms[i], bottoms[rest]) - np.maximum(tops[i], tops[rest]), 0, None)
+        intersections = widths * heights
+        ious = intersections / np.maximum(areas[i] + areas[rest] - intersections, 1)
+        order = rest[ious <= threshold]
+
+    STATS.count('tile faces merged', len(faces) - len(keep))
+    return [faces[i] for i in keep]
+
+
+def azface_detect_tiled(client, data, side=TILE_SIDE, overlap=TILE_OVERLAP, max_side=None, max_bytes=None, **kwargs):
+    """Detect faces in the large encoded image <data> tile by tile, to find faces too small to be found otherwise.
+
+    The image is split into tiles of <side> pixels overlapping by <overlap>
+    pixels, each enlarged by TILE_ZOOM within the size limit of the service,
+    and the tiles are detected concurrently along with the whole image,
+    shrunk by <max_side> and <max_bytes> if given, which finds the faces too
+    large for a tile.  The faces are mapped back to the image, and those
+    found more than once are merged by suppress_faces().
+    """
+
+    import cv2 as cv
+
+    image = decode_cv_image(data)
+    if image is None:  # Left for the service to report
+        return azface_detect_data(client, data, max_side=max_side, max_bytes=max_bytes, **kwargs)
+
+    height, width = image.shape[:2]
+    zoom = max(1.0, min(TILE_ZOOM, MAX_IMAGE_SIDE / side))
+    tiles = [(left, top) for top in get_tile_offsets(height, side, overlap)
+             for left in get_tile_offsets(width, side, overlap)]
+
+    def detect(tile):
+        if tile is None:
+            return azface_detect_data(client, data, max_side=max_side, max_bytes=max_bytes, **kwargs)
+
+        left, top = tile
+        with PROFILER.stage('shrink'):
+            part = image[top:top + side, left:left + side]
+            if zoom != 1.0:
+                part = cv.resize(part, None, fx=zoom, fy=zoom, interpolation=cv.INTER_CUBIC)
+            _, upload = cv.imencode('.jpg', part, [cv.IMWRITE_JPEG_QUALITY, UPLOAD_QUALITY])
+
+        start = time.time()
+        with PROFILER.stage('detect'):
+            faces = client.face.detect_with_stream(MemoryReader(upload), **kwargs)
+        STATS.count('upload seconds', time.time() - start)
+        STATS.count('upload bytes', len(upload))
+        STATS.count('tile calls')
+
+        if zoom != 1.0:
+            scale_faces(faces, 1 / zoom)
+        return shift_faces(faces, left, top)
+
+    with ContextExecutor(max_workers=min(len(tiles) + 1, DETECT_WORKERS)) as executor:
+        faces = [face for faces in executor.map(detect, [None] + tiles) for face in faces]
+
+    STATS.count('tiled photos')
+    return suppress_faces(faces)
+
+
+def azface_detect_many(client, img_urls, workers=DETECT_WORKERS, err=None, **kwargs):
+    """Detect faces in each of <img_urls> with up to <workers> requests in flight.
+
+    Yield (img_url, faces) in the order of <img_urls>.  A photo that fails is
+    reported on <err>, stderr by default, and yields None for its faces, so
+    that one bad photo does not stop the whole batch.
+    """
+
+    with ContextExecutor(max_workers=workers) as executor:
+
+        # Only keep a bounded number of photos queued ahead of the output
+
+        pending = collections.deque()
+        for img_url in img_urls:
+            pending.append((img_url, executor.submit(_try_detect, client, img_url, err, **kwargs)))
+            if len(pending) >= 2 * workers:
+                img_url, future = pending.popleft()
+                yield img_url, future.result()
+
+        while pending:
+            img_url, future = pending.popleft()
+            yield img_url, future.result()
+
+
+def _try_detect(client, img_url, err=None, **kwargs):
+
+    # Faces of azface_detect(), or None if it failed, as reported on <err>
+
+    try:
+        return azface_detect(client, img_url, **kwargs)
+    except Exception as e:
+        print("Failed to detect faces in {}: {}".format(img_url, e), file=err or sys.stderr)
+        return None
+
+
+class Mosaic:
+    """Layout of small photos tiled onto a canvas of at most <side> x <side> pixels, <padding> pixels apart.
+
+    Photos are laid out in rows, left to right, each in a square slot as
+    large as its longer side, so that it fits whatever its orientation.
+    """
+
+    def __init__(self, side=MOSAIC_SIDE, padding=MOSAIC_PADDING):
+        self.side = side
+        self.padding = padding
+        self.tiles = []  # (img_url, left, top, size) of each photo
+        self._left = padding
+        self._top = padding
+        self._height = 0  # Of the current row
+
+    def add(self, img_url, size):
+        """Lay out the photo <img_url> of <size> pixels on the longer side.  Return False if it does not fit."""
+
+        if self._left + size + self.padding > self.side:
+            self._left = self.padding
+            self._top += self._height + self.padding
+            self._height = 0
+        if self._top + size + self.padding > self.side:
+            return False
+
+        self.tiles.append((img_url, self._left, self._top, size))
+        self._left += size + self.padding
+        self._height = max(self._height, size)
+        return True
+
+
+def get_tile_size(img_url):
+    """Return the pixels on the longer side of the local photo <img_url> from its header, or None if unknown."""
+
+    if is_url(img_url):
+        return None
+    try:
+        with ImageHandle(img_url) as handle:
+            size = get_image_size(handle.data)
+    except OSError:  # Left for the service call to report
+        return None
+    return max(size) if size else None
+
+
+def azface_detect_mosaic(
+        client,
+        mosaic,
+        cache=None,
+        prefilter=None,
+        max_side=None,
+        max_bytes=None,
+        tile_side=None,
+        tile_overlap=None,
+        manifest=None,
+        **kwargs):
+    """Detect faces in the small photos laid out by the Mosaic <mosaic> with a single call of the service.
+
+    The photos are tiled onto one image, faces are mapped back to the photo
+    of the tile their center is in, and faces reaching beyond the padding
+    around their tile, into another photo, are discarded.  <cache> and
+    <prefilter> are as in azface_detect(), and photos found in the cache or
+    screened out by the prefilter are left out of the call.  Photos detected
+    are recorded in the FileManifest <manifest> if given.  <max_side> and
+    <max_bytes> only tell the cache keys of the photos, which are small
+    enough not to be shrunk, and <tile_side> and <tile_overlap> are unused.
+
+    Returns {img_url: faces} of the photos detected.  Photos missing, such
+    as those which cannot be decoded, or all the photos if the call returns
+    as many faces as it can, so that some may be lost, are to be detected
+    on their own.
+    """
+
+    import cv2 as cv
+    import numpy as np
+
+    results = {}
+    tiles = []  # (img_url, left, top, width, height, cache key) of the photos in the call
+    digests = {}  # Of the photos, to be recorded in the manifest once detected
+    canvas = None
+
+    def recorded(results):
+        if manifest is not None:
+            for img_url in results:
+                manifest.add(img_url, digests[img_url])
+        return results
+
+    with contextlib.ExitStack() as stack:
+        for img_url, left, top, size in mosaic.tiles:
+            handle = stack.enter_context(ImageHandle(img_url))
+            if manifest is not None:
+                digests[img_url] = handle.digest
+            key = None
+            if cache is not None:
+                key = cache.make_key(handle.digest, max_side=max_side, max_bytes=max_bytes, **kwargs)
+                with PROFILER.stage('cache'):
+                    faces = cache.get(key)
+                if faces is not None:
+                    results[img_url] = faces
+                    continue
+            if prefilter is not None and not prefilter.has_face(handle.data):
+                results[img_url] = []
+                continue
+
+            image, _ = handle.decode()
+            if image is None or max(image.shape[:2]) > size:  # Header and image disagree
+                continue
+            height, width = image.shape[:2]
+            if canvas is None:
+                canvas = np.zeros((mosaic.side, mosaic.side, 3), dtype=np.uint8)
+            canvas[top:top + height, left:left + width] = image
+            tiles.append((img_url, left, top, width, height, key))
+
+    if not tiles:
+        return recorded(results)
+
+    with PROFILER.stage('mosaic'):
+        right = max(left + width for _, left, _, width, _, _ in tiles) + mosaic.padding
+        bottom = max(top + height for _, _, top, _, height, _ in tiles) + mosaic.padding
+        _, data = cv.imencode('.jpg', canvas[:bottom, :right], [cv.IMWRITE_JPEG_QUALITY, UPLOAD_QUALITY])
+
+    start = time.time()
+    with PROFILER.stage('detect'):
+        faces = client.face.detect_with_stream(MemoryReader(data), **kwargs)
+    STATS.count('upload seconds', time.time() - start)
+    STATS.count('upload bytes', len(data))
+    STATS.count('mosaic calls')
+    if len(faces) >= MOSAIC_MAX_FACES:
+        STATS.count('mosaics with too many faces')
+        return recorded(results)
+
+    # Map each face to the photo of the tile its center is in
+
+    margin = mosaic.padding // 2
+    tile_faces = {img_url: [] for img_url, *_ in tiles}
+    for face in faces:
+        rect = face.face_rectangle
+        x, y = rect.left + rect.width / 2, rect.top + rect.height / 2
+        for img_url, left, top, width, height, _ in tiles:
+            if left <= x < left + width and top <= y < top + height:
+                if (rect.left >= left - margin and rect.top >= top - margin
+                        and rect.left + rect.width <= left + width + margin
+                        and rect.top + rect.height <= top + height + margin):
+                    right = min(rect.left + rect.width, left + width)  # Clipped to the photo
+                    bottom = min(rect.top + rect.height, top + height)
+                    rect.left, rect.top = max(rect.left, left), max(rect.top, top)
+                    rect.width, rect.height = right - rect.left, bottom - rect.top
+                    tile_faces[img_url].append(shift_faces([face], -left, -top)[0])
+                else:
+                    STATS.count('mosaic faces discarded')
+                break
+        else:  # In the padding, across tiles
+            STATS.count('mosaic faces discarded')
+
+    for img_url, _, _, _, _, key in tiles:
+        STATS.count('mosaic photos')
+        results[img_url] = tile_faces[img_url]
+        if key is not None:
+            with PROFILER.stage('cache'):
+                cache.put(key, tile_faces[img_url])
+
+    return recorded(results)
+
+
+def azface_detect_many_mosaic(
+        client,
+        img_urls,
+        workers=DETECT_WORKERS,
+        cell=MOSAIC_CELL,
+        side=MOSAIC_SIDE,
+        padding=MOSAIC_PADDING,
+        dedup=None,
+        err=None,
+        **kwargs):
+    """Detect faces in each of <img_urls> like azface_detect_many(), but small photos many at a time.
+
+    Local photos of at most <cell> pixels on the longer side are laid out on
+    Mosaics of <side> x <side> pixels, and detected by one call per mosaic
+    with azface_detect_mosaic(), which saves round trips and transactions.
+    Other photos are detected on their own by azface_detect(), with the
+    DuplicateIndex <dedup> if given.  <kwargs> are passed to both.  Yield
+    (img_url, faces) in the order of <img_urls>, with failures reported on
+    <err> as by azface_detect_many().
+    """
+
+    max_side = kwargs.get('max_side')
+
+    def detect_mosaic(mosaic):
+        try:
+            results = azface_detect_mosaic(client, mosaic, **kwargs)
+        except Exception as e:
+            print("Failed to detect faces in a mosaic of {} photos, detecting them one by one: {}".format(
+                len(mosaic.tiles), e), file=err or sys.stderr)
+            results = {}
+        return [results[img_url] if img_url in results else _try_detect(client, img_url, err, dedup=dedup, **kwargs)
+                for img_url, *_ in mosaic.tiles]
+
+    def detect(img_url):
+        return [_try_detect(client, img_url, err, dedup=dedup, **kwargs)]
+
+    with ContextExecutor(max_workers=workers) as executor:
+
+        # Only keep a bounded number of calls queued ahead of the output.  Photos of the
+        # mosaic being laid out are held, and those after them wait for their results.
+
+        pending = collections.deque()  # (photos, future of their faces) of each call
+        results = {}  # (img_url, faces) of each photo detected by its position in img_urls
+        position = 0  # Of the next photo to yield
+
+        def collect(photos, future):
+            nonlocal position
+            results.update((i, (img_url, faces)) for (i, img_url), faces in zip(photos, future.result()))
+            while position in results:
+                yield results.pop(position)
+                position += 1
+
+        mosaic, photos = Mosaic(side, padding), []
+        for i, img_url in enumerate(img_urls):
+            size = get_tile_size(img_url)
+            if size is None or size > cell or (max_side and size > max_side) or size + 2 * padding > side:
+                pending.append(([(i, img_url)], executor.submit(detect, img_url)))
+            else:
+                if not mosaic.add(img_url, size):  # Full
+                    pending.append((photos, executor.submit(detect_mosaic, mosaic)))
+                    mosaic, photos = Mosaic(side, padding), []
+                    mosaic.add(img_url, size)  # Fits in an empty mosaic, as checked above
+                photos.append((i, img_url))
+
+            while len(pending) >= 2 * workers:
+                yield from collect(*pending.popleft())
+
+        if photos:
+            pending.append((photos, executor.submit(detect_mosaic, mosaic)))
+        while pending:
+            yield from collect(*pending.popleft())
+
+
+def azface_find_similar(client, target_faces, candidate_faces, workers=DETECT_WORKERS):
+    """Find the faces in <candidate_faces> similar to each of <target_faces>.
+
+    The find_similar calls for the target faces are made concurrently with up
+    to <workers> requests in flight, each against at most
+    MAX_SIMILAR_CANDIDATES candidate faces.
+
+    Returns a dict from the face ID of each target face to its list of SimilarFace.
+    """
+
+    candidate_ids = [face.face_id for face in candidate_faces]
+    chunks = [candidate_ids[i:i + MAX_SIMILAR_CANDIDATES] for i in range(0, len(candidate_ids), MAX_SIMILAR_CANDIDATES)]
+
+    def find(face_id, face_ids):
+        with PROFILER.stage('find_similar'):
+            return client.face.find_similar(face_id, face_ids=face_ids, max_num_of_candidates_returned=len(face_ids))
+
+    similar = {face.face_id: [] for face in target_faces}
+    with ContextExecutor(max_workers=workers) as executor:
+        futures = [(face.face_id, executor.submit(find, face.face_id, ids)) for face in target_faces for ids in chunks]
+        for face_id, future in futures:
+            similar[face_id].extend(future.result())
+
+    return similar
+
+
+def get_similarity_matrix(target_faces, candidate_faces, similar):
+    """Return the confidence of each face in <candidate_faces> matching each face in <target_faces>.
+
+    <similar> is the result of azface_find_similar(), which may cover more
+    candidate faces than <candidate_faces>.  Returns a numpy array with a row
+    per target face and a column per candidate face, in their order, which
+    is 0 where the service found no similarity.
+    """
+
+    import numpy as np
+
+    columns = {face.face_id: j for j, face in enumerate(candidate_faces)}
+    matrix = np.zeros((len(target_faces), len(candidate_faces)))
+    for i, face in enumerate(target_faces):
+        for x in similar.get(face.face_id, []):
+            j = columns.get(x.face_id)
+            if j is not None:
+                matrix[i, j] = x.confidence
+
+    return matrix
+
+
+def _hungarian(cost):
+
+    # Hungarian algorithm with potentials, in O(n^2 m) for n <= m, of rows to columns of least total <cost>
+
+    import numpy as np
+
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    u = np.zeros(n + 1)  # Potentials of rows and columns, 1-based
+    v = np.zeros(m + 1)
+    row = np.zeros(m + 1, dtype=int)  # Row assigned to each column, 0 if none
+    way = np.zeros(m + 1, dtype=int)  # Previous column on the augmenting path
+    for i in range(1, n + 1):
+        row[0] = i
+        j0 = 0
+        slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while row[j0] != 0:
+            used[j0] = True
+            i0 = row[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            lower = free & (reduced < slack[1:])
+            slack[1:][lower] = reduced[lower]
+            way[1:][lower] = j0
+            candidates = np.where(free, slack[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[row[used]] += delta
+            v[used] -= delta
+            slack[1:][free] -= delta
+            j0 = j1
+        while j0:  # Augment along the path
+            j1 = way[j0]
+            row[j0] = row[j1]
+            j0 = j1
+
+    columns = np.nonzero(row[1:])[0]
+    rows = row[1:][columns] - 1
+    if transposed:
+        rows, columns = columns, rows
+    order = np.argsort(rows)
+    return rows[order], columns[order]
+
+
+def solve_assignment(cost):
+    """Return (rows, columns) of the one to one assignment of the rows of <cost> to its columns of least total cost.
+
+    <cost> is a 2-D numpy array.  The assignment is solved by
+    scipy.optimize.linear_sum_assignment if scipy is installed, or else by
+    the Hungarian algorithm in numpy.
+    """
+
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        return _hungarian(cost)
+
+    return linear_sum_assignment(cost)
+
+
+def match_similar(target_faces, candidate_faces, similar, threshold=None):
+    """Match faces in <candidate_faces> one to one with faces in <target_faces>, for the highest total confidence.
+
+    <similar> is the result of azface_find_similar(), which may cover more
+    candidate faces than <candidate_faces>.  Matches are solved optimally
+    over the whole get_similarity_matrix(), so that they do not depend on
+    the order of the faces.  Faces matching with a confidence below
+    <threshold>, if given, are not matched.  Returns a dict from the face ID
+    of each matched candidate face to (target face, confidence).
+    """
+
+    matrix = get_similarity_matrix(target_faces, candidate_faces, similar)
+    if threshold:
+        matrix[matrix < threshold] = 0
+    if not matrix.any():
+        return {}
+
+    rows, columns = solve_assignment(-matrix)
+    return {candidate_faces[j].face_id: (target_faces[i], float(matrix[i, j]))
+            for i, j in zip(rows, columns) if matrix[i, j] > 0}
+
+
+def azface_similar(client, target_faces, candidate_faces, workers=DETECT_WORKERS, threshold=None):
     matches = {}
     if candidate_faces:
-        candidate_ids = [x.face_id for x in candidate_faces]
 
-        for query_face in target_faces:
+        # Call Azure face API to find matches
+
+        similar = azface_find_similar(client, target_faces, candidate_faces, workers=workers)
+        matches = match_similar(target_faces, candidate_faces, similar, threshold=threshold)
 
-            # Call Azure face API to find matches
+    return matches
 
-            similar_faces = client.face.find_similar(query_face.face_id, face_ids=candidate_ids)
 
-            # Update the best matched face
+def azface_index(client, img_urls, index, workers=DETECT_WORKERS, prefilter=None):
+    """Enroll the faces in <img_urls> into the LargeFaceList of the FaceIndex <index>.
 
-            if similar_faces:
-                best_match = max(similar_faces, key=lambda face: face.confidence)
-                match_face = next(x for x in candidate_faces if x.face_id == best_match.face_id)
-                if match_face.face_id not in matches or matches[match_face.face_id][1] < best_match.confidence:
-                    matches[match_face.face_id] = (query_face, best_match.confidence)
+    The face list is created if not available.  Photos already in <index> are
+    skipped, so that a growing corpus can be indexed incrementally.  Once all
+    photos are enrolled, the face list is trained if any face was added.
 
-    return matches
+    Photos without faces according to the FacePrefilter <prefilter>, if given,
+    are recorded in <index> without faces, so that later runs skip them too.
+    If a photo fails part way, the faces of it already added to the face list
+    are deleted again, so that a later run does not add them twice.
+
+    Yield (img_url, faces) for each newly enrolled photo, where faces is a
+    list of IndexedFace.
+    """
+
+    from azure.cognitiveservices.vision.face.models import APIErrorException
+
+    face_list_id = index.face_list_id
+    try:
+        client.large_face_list.get(face_list_id)
+    except APIErrorException as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        client.large_face_list.create(face_list_id, name=face_list_id)
+
+    def enroll(img_url):
+        with ImageHandle(img_url) as handle:
+            if index.has_photo(handle.digest):
+                return None
+
+            if prefilter is not None and not prefilter.has_face(handle.data):
+                index.add_photo(handle.digest, img_url, [])
+                return None
+
+            faces = []
+            try:
+                for face in client.face.detect_with_stream(handle.open(), return_face_id=False):
+                    rect = face.face_rectangle
+                    rect = Rectangle(rect.left, rect.top, rect.width, rect.height)
+                    persisted = client.large_face_list.add_face_from_stream(
+                        face_list_id,
+                        handle.open(),
+                        user_data=img_url[-1024:],
+                        target_face=list(rect))
+                    faces.append(IndexedFace(persisted.persisted_face_id, img_url, rect))
+                    index.add_face(faces[-1])  # Known locally even if deleting it below fails
+            except Exception:
+                for face in faces:
+                    try:
+                        client.large_face_list.delete_face(face_list_id, face.persisted_face_id)
+                    except Exception:
+                        continue
+                    index.remove_face(face.persisted_face_id)
+                raise
+
+            index.add_photo(handle.digest, img_url, faces)
+            return faces
+
+    added = 0
+    with ContextExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        img_urls = iter(img_urls)
+        while True:
+            for img_url in img_urls:
+                pending.append((img_url, executor.submit(enroll, img_url)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            img_url, future = pending.popleft()
+            try:
+                faces = future.result()
+            except Exception as e:
+                print("Failed to index {}: {}".format(img_url, e), file=sys.stderr)
+                continue
+
+            if faces is not None:
+                added += len(faces)
+                yield img_url, faces
+
+    if added:
+        client.large_face_list.train(face_list_id)
+        status = wait_for_training(lambda: client.large_face_list.get_training_status(face_list_id))
+        if get_training_state(status) == 'failed':
+            raise RuntimeError("Training of face list {} failed: {}".format(face_list_id, status.message))
+
+
+def azface_search_index(client, target_faces, index, top=1, workers=DETECT_WORKERS):
+    """Find the faces in the LargeFaceList of the FaceIndex <index> similar to each of <target_faces>.
+
+    Each target face takes a single find_similar call, concurrently with up to
+    <workers> in flight, whatever the size of the face list.  Returns a dict
+    from the face ID of each target face to a list of (IndexedFace, confidence)
+    of at most <top> best matches.
+    """
+
+    def find(face_id):
+        with PROFILER.stage('find_similar'):
+            return client.face.find_similar(
+                face_id,
+                large_face_list_id=index.face_list_id,
+                max_num_of_candidates_returned=top)
+
+    with ContextExecutor(max_workers=workers) as executor:
+        futures = [(face.face_id, executor.submit(find, face.face_id)) for face in target_faces]
+        results = {}
+        for face_id, future in futures:
+            matches = ((index.get_face(x.persisted_face_id), x.confidence) for x in future.result())
+            results[face_id] = [(face, confidence) for face, confidence in matches if face is not None]
+
+    return results
+
+
+def azface_identify(group, faces, top=1, threshold=None, workers=DETECT_WORKERS):
+    """Identify each of <faces> among the persons of the trained PersonGroup <group>.
+
+    Faces are identified IDENTIFY_BATCH at a time, the most allowed by one
+    identify call, with up to <workers> calls in flight.  At most <top>
+    candidates of each face are found, of confidence at least <threshold> if
+    given, or else the default threshold of the person group.  Returns a dict
+    from the face ID of each face to its list of IdentifyCandidate.
+    """
+
+    face_ids = [face.face_id for face in faces]
+    batches = [face_ids[i:i + IDENTIFY_BATCH] for i in range(0, len(face_ids), IDENTIFY_BATCH)]
+
+    results = {}
+    with ContextExecutor(max_workers=workers) as executor:
+        for identified in executor.map(lambda batch: group.identify(batch, top=top, threshold=threshold), batches):
+            STATS.count('identify calls')
+            results.update((result.face_id, result.candidates) for result in identified)
+
+    return results
 
 
 def show_similar_results(target_url, target_faces, candidate_url, candidate_faces, matches):
@@ -436,20 +3249,22 @@ def show_similar_results(target_url, target_faces, candidate_url, candidate_face
 
         # Mark matched faces
 
-        target_bgr = read_cv_image_from(target_url)
-        candidate_bgr = read_cv_image_from(candidate_url)
+        with ImageHandle(target_url) as target, ImageHandle(candidate_url) as candidate:
+            target_bgr, target_scale = target.decode(DISPLAY_SIDE)
+            candidate_bgr, candidate_scale = candidate.decode(DISPLAY_SIDE)
 
         for face in target_faces:
-            mark_face(target_bgr, getbox(face), text=labels[face.face_id])
+            mark_face(target_bgr, scale_box(getbox(face), target_scale), text=labels[face.face_id])
 
         description = []
         for face in candidate_faces:
+            box = scale_box(getbox(face), candidate_scale)
             if face.face_id in matches:
                 number = labels[matches[face.face_id][0].face_id]
-                mark_face(candidate_bgr, getbox(face), text=number)
+                mark_face(candidate_bgr, box, text=number)
                 description.append("Face No. {}: {}".format(number, matches[face.face_id][1]))
             else:
-                mark_face(candidate_bgr, getbox(face), text='?')
+                mark_face(candidate_bgr, box, text='?')
 
         # Plot results
 
@@ -464,7 +3279,10 @@ def show_similar_results(target_url, target_faces, candidate_url, candidate_face
         print("No faces found in {}".format(candidate_url), file=sys.stderr)
 
 
-def print_similar_results(target_faces, candidate_faces, matches):
+def print_similar_results(target_faces, candidate_faces, matches, tag=None, file=None):
+    """Print matched and unmatched faces one per line to <file>, prefixed with <tag> if any, such as the photo paths."""
+
+    prefix = '' if tag is None else tag + ','
     target_ids = {face.face_id: face for face in target_faces}
     candidate_ids = {face.face_id: face for face in candidate_faces}
 
@@ -482,25 +3300,70 @@ def print_similar_results(target_faces, candidate_faces, matches):
                     target_coordinates,
                     match_coordinates,
                     confidence)
-                print(description)
+                print(prefix + description, file=file)
 
     # unmatched faces
 
     for face in target_ids.values():
         target_coordinates = " ".join([str(x) for x in getbox_points(face)])
         description = "{},,".format(target_coordinates)
-        print(description)
+        print(prefix + description, file=file)
 
     for face in candidate_ids.values():
         match_coordinates = " ".join([str(x) for x in getbox_points(face)])
         description = ",{},".format(match_coordinates)
-        print(description)
+        print(prefix + description, file=file)
+
 
+def print_index_results(target_faces, results, tag=None, file=None):
+    """Print the matches of <target_faces> in <results> of azface_search_index() one per line to <file>.
 
-def azface_add(client, img_url, name, person=None):
-    """Add the face in img_url to the person name."""
+    Each line is prefixed with <tag> if any, followed by the photo of the
+    matched face, in the format of print_similar_results() otherwise.
+    """
+
+    prefix = '' if tag is None else tag + ','
+    for face in target_faces:
+        target_coordinates = " ".join([str(x) for x in getbox_points(face)])
+        matches = results.get(face.face_id)
+        if not matches:
+            print("{},{},,".format(prefix, target_coordinates), file=file)
+        for match_face, confidence in matches or []:
+            match_coordinates = " ".join([str(x) for x in getbox_points(match_face)])
+            description = "{},{},{},{}".format(match_face.path, target_coordinates, match_coordinates, confidence)
+            print(prefix + description, file=file)
+
+
+def print_identify_results(faces, results, names, tag=None, file=None):
+    """Print the candidates of <faces> in <results> of azface_identify() one per line to <file>.
+
+    Each line is prefixed with <tag> if any, followed by the coordinates of
+    the face, the name of the candidate person in <names>, a dict from person
+    IDs to names, and the confidence.  Faces without candidates have no name
+    and confidence.
+    """
+
+    prefix = '' if tag is None else tag + ','
+    for face in faces:
+        coordinates = " ".join([str(x) for x in getbox_points(face)])
+        candidates = results.get(face.face_id)
+        if not candidates:
+            print("{}{},,".format(prefix, coordinates), file=file)
+        for candidate in candidates or []:
+            name = names.get(candidate.person_id, candidate.person_id)
+            print("{}{},{},{}".format(prefix, coordinates, name, candidate.confidence), file=file)
+
+
+def azface_add(client, img_url, name, person=None, show=False):
+    """Add the face in img_url to the person name.
+
+    The photo is displayed first if <show> is True.  To add many photos of
+    many persons, see azface_enroll().
+    """
 
-    display(read_cv_image_from(img_url), frombgr=True)
+    if show:
+        with ImageHandle(img_url) as handle:
+            display(handle.decode(DISPLAY_SIDE)[0], frombgr=True)
 
     # Use the person name as person group ID and person group name
 
@@ -515,15 +3378,15 @@ def azface_add(client, img_url, name, person=None):
         person_groups = client.person_group.list()
         person_groups = [x.person_group_id for x in person_groups]
 
-        # Get the list of persons in the person group
-
-        person_list = client.person_group_person.list(person_group_id)
-
         # Create a person group if not available
 
         if person_group_id not in person_groups:
             client.person_group.create(person_group_id, name=person_group_name)
 
+        # Get the list of persons in the person group
+
+        person_list = client.person_group_person.list(person_group_id)
+
         # Create a person belongs to the person group if not available
 
         try:
@@ -537,6 +3400,508 @@ def azface_add(client, img_url, name, person=None):
         client.person_group_person.add_face_from_url(person_group_id, person.person_id, img_url)
     else:  # Photo from a file
         with open(img_url, 'rb') as file:
-            client.person_group_person.add_face_from_url(person_group_id, person.person_id, file)
+            client.person_group_person.add_face_from_stream(person_group_id, person.person_id, file)
 
     return person
+
+
+def list_people(folder):
+    """Return a dict from the name of each sub-folder of <folder> to the photos under it.
+
+    <folder> has one sub-folder of photos per person, named after the person,
+    as docs/photo/PersonGroup.  Files which are not photos are ignored.
+    """
+
+    people = {}
+    for entry in sorted(os.scandir(folder), key=lambda x: x.name):
+        if entry.is_dir():
+            photos = list(list_files(entry.path, -1, IMAGE_EXTENSIONS))
+            if photos:
+                people[entry.name] = photos
+    return people
+
+
+def azface_enroll(group, people, workers=DETECT_WORKERS, index=None, scheduler=None):
+    """Enroll the photos of <people>, a dict from person names to photos, into the PersonGroup <group>.
+
+    The group and its persons are listed once, and those missing are created
+    concurrently.  The face in each photo is then added to its person with up
+    to <workers> requests in flight.  The group is trained by the
+    TrainingScheduler <scheduler> if given, as faces are added, or else once
+    all faces are added.
+
+    If the FaceIndex <index> is given, photos already enrolled as the same
+    person are skipped, so that a growing gallery can be enrolled
+    incrementally.
+
+    Yield (name, img_url, persisted_face_id) for each photo newly enrolled,
+    where persisted_face_id is None if the photo failed, which is reported
+    on stderr.
+    """
+
+    group.create_if_missing()
+    persons = {person.name: person.person_id for person in group.list_persons()}
+
+    def add(name, img_url):
+        if index is None:
+            if is_url(img_url):
+                persisted_face_id = group.add_face(persons[name], img_url)
+            else:
+                with open(img_url, 'rb') as file:
+                    persisted_face_id = group.add_face(persons[name], file)
+        else:
+            with ImageHandle(img_url) as handle:
+                digest = "{}/{}".format(name, handle.digest)
+                if index.has_photo(digest):
+                    return False
+
+                persisted_face_id = group.add_face(persons[name], handle.open())
+                index.add_photo(digest, img_url, [])
+
+        if scheduler is not None:
+            scheduler.changed()
+        return persisted_face_id
+
+    added = 0
+    with ContextExecutor(max_workers=workers) as executor:
+
+        # Create the missing persons
+
+        missing = [name for name in people if name not in persons]
+        for name, person_id in zip(missing, executor.map(group.create_person, missing)):
+            persons[name] = person_id
+            STATS.count('created persons')
+
+        # Add the faces of all persons, only keeping a bounded number of photos queued
+
+        pending = collections.deque()
+        photos = ((name, img_url) for name, img_urls in people.items() for img_url in img_urls)
+        while True:
+            for name, img_url in photos:
+                pending.append((name, img_url, executor.submit(add, name, img_url)))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            name, img_url, future = pending.popleft()
+            try:
+                persisted_face_id = future.result()
+            except Exception as e:
+                print("Failed to enroll {} as {}: {}".format(img_url, name, e), file=sys.stderr)
+                persisted_face_id = None
+
+            if persisted_face_id is False:  # Enrolled before
+                continue
+            if persisted_face_id is not None:
+                added += 1
+            yield name, img_url, persisted_face_id
+
+    if scheduler is not None:
+        scheduler.flush()
+    elif added:
+        group.train()
+        group.check_trained()
+
+
+# ----------------------------------------------------------------------
+# Output
+# ----------------------------------------------------------------------
+
+EMOTIONS = ['anger', 'contempt', 'disgust', 'fear', 'happiness', 'neutral', 'sadness', 'surprise']
+OCCLUSIONS = ['forehead_occluded', 'eye_occluded', 'mouth_occluded']
+
+
+def _rectangle_schema(prefix=''):
+    return [(prefix + name, int) for name in ('left', 'top', 'width', 'height')]
+
+
+# Fields of the result records as (name, type)
+
+DETECTION_SCHEMA = (
+    [('path', str), ('face', int)]
+    + _rectangle_schema()
+    + [('age', float), ('gender', str), ('glasses', str)]
+    + [('emotion_' + name, float) for name in EMOTIONS]
+    + [(name, bool) for name in OCCLUSIONS])
+
+SIMILAR_SCHEMA = (
+    [('target_path', str)]
+    + _rectangle_schema('target_')
+    + [('candidate_path', str)]
+    + _rectangle_schema('candidate_')
+    + [('confidence', float)])
+
+
+def _value(x):
+    return getattr(x, 'value', x)  # The value of enums such as Gender
+
+
+def _rectangle_fields(face, prefix=''):
+    rect = face.face_rectangle
+    return {
+        prefix + 'left': rect.left,
+        prefix + 'top': rect.top,
+        prefix + 'width': rect.width,
+        prefix + 'height': rect.height,
+    }
+
+
+def get_detection_records(faces, path=None):
+    """Yield the record of DETECTION_SCHEMA of each of <faces>, detected in the photo <path>."""
+
+    for i, face in enumerate(faces):
+        record = dict(path=path, face=i, **_rectangle_fields(face))
+        attrs = face.face_attributes
+        if attrs is not None:
+            record.update(age=attrs.age, gender=_value(attrs.gender), glasses=_value(attrs.glasses))
+            if attrs.emotion is not None:
+                record.update(('emotion_' + name, getattr(attrs.emotion, name)) for name in EMOTIONS)
+            if attrs.occlusion is not None:
+                record.update((name, getattr(attrs.occlusion, name)) for name in OCCLUSIONS)
+        yield record
+
+
+def get_similar_records(target_faces, candidate_faces, matches, target_path=None, candidate_path=None):
+    """Yield the records of SIMILAR_SCHEMA of the faces printed by print_similar_results(), in the same order."""
+
+    target_ids = {face.face_id: face for face in target_faces}
+    candidate_ids = {face.face_id: face for face in candidate_faces}
+
+    for face in candidate_faces:
+        if face.face_id in matches:
+            target_face, confidence = matches[face.face_id]
+            del target_ids[target_face.face_id]
+            del candidate_ids[face.face_id]
+            yield dict(
+                target_path=target_path,
+                candidate_path=candidate_path,
+                confidence=confidence,
+                **_rectangle_fields(target_face, 'target_'),
+                **_rectangle_fields(face, 'candidate_'))
+
+    for face in target_ids.values():
+        yield dict(target_path=target_path, **_rectangle_fields(face, 'target_'))
+
+    for face in candidate_ids.values():
+        yield dict(candidate_path=candidate_path, **_rectangle_fields(face, 'candidate_'))
+
+
+def get_index_records(target_faces, results, target_path=None):
+    """Yield the records of SIMILAR_SCHEMA of the faces printed by print_index_results(), in the same order."""
+
+    for face in target_faces:
+        matches = results.get(face.face_id)
+        if not matches:
+            yield dict(target_path=target_path, **_rectangle_fields(face, 'target_'))
+        for match_face, confidence in matches or []:
+            yield dict(
+                target_path=target_path,
+                candidate_path=match_face.path,
+                confidence=confidence,
+                **_rectangle_fields(face, 'target_'),
+                **_rectangle_fields(match_face, 'candidate_'))
+
+
+class ResultWriter:
+    """Writer of result records to the text file <file>, <buffer_size> records at a time.
+
+    Each record is a dict of the fields in <schema>, a list of (name, type),
+    where missing fields are null.  The file is closed by close() only if
+    <closing> is True, and flushed otherwise.
+    """
+
+    def __init__(self, file, schema, buffer_size=WRITE_BUFFER, closing=False):
+        self.file = file
+        self.schema = schema
+        self.names = [name for name, _ in schema]
+        self.buffer_size = buffer_size
+        self.closing = closing
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def format(self, record):
+        """Return the text of <record> in the file."""
+
+        raise NotImplementedError
+
+    def write(self, record):
+        self._buffer.append(self.format(record))
+        if len(self._buffer) >= self.buffer_size:
+            with PROFILER.stage('write'):
+                self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self._buffer:
+            self.file.write(''.join(self._buffer))  # One write, and one message through the daemon
+            self._buffer = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.closing:
+            self.file.close()
+
+
+class JSONLWriter(ResultWriter):
+    """Writer of result records as JSON lines."""
+
+    def format(self, record):
+        return json.dumps({name: record.get(name) for name in self.names}) + '\n'
+
+
+class CSVWriter(ResultWriter):
+    """Writer of result records as CSV lines, after a header line of the field names."""
+
+    def __init__(self, file, schema, buffer_size=WRITE_BUFFER, closing=False):
+        super().__init__(file, schema, buffer_size, closing)
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text, lineterminator='\n')
+        self._buffer.append(self._format_row(self.names))
+
+    def _format_row(self, row):
+        self._text.seek(0)
+        self._text.truncate()
+        self._writer.writerow(row)
+        return self._text.getvalue()
+
+    def format(self, record):
+        return self._format_row([record.get(name) for name in self.names])
+
+
+class ParquetWriter(ResultWriter):
+    """Writer of result records as a Parquet file at <path>, one row group of <buffer_size> records at a time.
+
+    Requires pyarrow.
+    """
+
+    def __init__(self, path, schema, buffer_size=PARQUET_ROW_GROUP):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("The parquet format requires pyarrow, to be installed by: pip3 install pyarrow") from e
+
+        types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+        super().__init__(None, schema, buffer_size)
+        self._schema = pa.schema([(name, types[type_]) for name, type_ in schema])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def format(self, record):
+        return [record.get(name) for name in self.names]
+
+    def flush(self):
+        import pyarrow as pa
+
+        if self._buffer:
+            columns = zip(*self._buffer)
+            self._writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+                schema=self._schema))
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def get_result_writer(format, schema, output=None, file=None):
+    """Return a writer of records of <schema> in <format> to the file <output>, or to <file> if not given.
+
+    Returns None for the text format, which is printed by print_detection_results() and the like.
+    """
+
+    if format == 'text':
+        return None
+    if format == 'parquet':
+        return ParquetWriter(output, schema)
+
+    cls = {'jsonl': JSONLWriter, 'csv': CSVWriter}[format]
+    if output:
+        return cls(open(output, 'w', newline=''), schema, closing=True)
+    return cls(file or sys.stdout, schema)
+
+
+# ----------------------------------------------------------------------
+# Commands
+# ----------------------------------------------------------------------
+
+def detect_photos(
+        client,
+        img_urls,
+        tagged=False,
+        workers=DETECT_WORKERS,
+        file=None,
+        renderer=None,
+        writer=None,
+        manifest=None,
+        mosaic=None,
+        err=None,
+        **kwargs):
+    """Detect faces in <img_urls> and print the results to <file> as the detect command does.
+
+    <kwargs> are passed to azface_detect().  Photos that fail are reported on
+    <err>, stderr by default.  Results are tagged with their
+    photos if <tagged> is True.  If the ResultWriter <writer> is given, the
+    results are written by it as records of DETECTION_SCHEMA instead.  Photos
+    with faces are marked and saved by the Renderer <renderer> if given.
+    Photos detected are recorded in the FileManifest <manifest> if given.
+    If <mosaic> is given, photos of at most <mosaic> pixels on the longer
+    side are detected many at a time by azface_detect_many_mosaic().
+    Returns the number of photos that failed.
+    """
+
+    if mosaic:
+        results = azface_detect_many_mosaic(
+            client, img_urls, workers=workers, cell=mosaic, err=err, manifest=manifest, **kwargs)
+    else:
+        results = azface_detect_many(client, img_urls, workers=workers, err=err, manifest=manifest, **kwargs)
+
+    failed = 0
+    for img_url, faces in results:
+        if faces is None:
+            failed += 1
+        if writer is not None:
+            writer.write_all(get_detection_records(faces or [], img_url))
+        else:
+            print_detection_results(faces, tag=img_url if tagged else None, file=file)
+        if renderer is not None and faces:
+            renderer.submit([(img_url, get_detection_marks(faces))], img_url)
+
+    return failed
+
+
+def identify_photos(
+        client,
+        img_urls,
+        group,
+        tagged=False,
+        workers=DETECT_WORKERS,
+        top=1,
+        threshold=None,
+        file=None,
+        **kwargs):
+    """Identify the faces in <img_urls> and print the results to <file> as the identify command does.
+
+    Faces of many photos are identified together, so that each identify call
+    takes as many faces as allowed, among the persons of the PersonGroup
+    <group>.  <kwargs> are passed to azface_detect().  Results are tagged
+    with their photos if <tagged> is True.  Raises RuntimeError if the group
+    is not trained.
+    """
+
+    group.check_trained()
+    names = {person.person_id: person.name for person in group.list_persons()}
+
+    def identify(photos):
+        faces = [face for _, faces in photos for face in faces]
+        results = azface_identify(group, faces, top=top, threshold=threshold, workers=workers)
+        for img_url, faces in photos:
+            print_identify_results(faces, results, names, tag=img_url if tagged else None, file=file)
+
+    # Detect faces in photos as they come, and identify them once enough for full calls are found
+
+    photos = []
+    count = 0
+    for img_url, faces in azface_detect_many(client, img_urls, workers=workers, **kwargs):
+        photos.append((img_url, faces or []))
+        count += len(faces or [])
+        if count >= IDENTIFY_BATCH * workers:
+            identify(photos)
+            photos = []
+            count = 0
+
+    if photos:
+        identify(photos)
+
+
+def similar_photos(
+        client,
+        target_urls,
+        candidate_urls,
+        tagged=False,
+        workers=DETECT_WORKERS,
+        index=None,
+        top=1,
+        threshold=None,
+        file=None,
+        renderer=None,
+        writer=None,
+        err=None,
+        **kwargs):
+    """Find similar faces and print the results to <file> as the similar command does.
+
+    The faces in <target_urls> are searched in <candidate_urls>, or in the
+    FaceIndex <index> if given, for the <top> best matches of each.  Faces of
+    candidate photos are matched with a confidence of at least <threshold>,
+    if given, by match_similar().  <kwargs> are passed to azface_detect().
+    Results are tagged with their photos if <tagged> is True.  If the
+    ResultWriter <writer> is given, the results are written by it as records
+    of SIMILAR_SCHEMA instead.  Each pair of target and candidate photos with
+    matched faces is marked and saved side by side by the Renderer <renderer>
+    if given.  Photos that fail are reported on <err>, stderr by default.
+    Returns False if no faces are found.
+    """
+
+    # Detect faces
+
+    results = dict(azface_detect_many(client, target_urls + candidate_urls, workers=workers, err=err, **kwargs))
+
+    target_faces = {url: results[url] or [] for url in target_urls}
+    candidate_faces = {url: results[url] or [] for url in candidate_urls}
+    all_target_faces = [face for faces in target_faces.values() for face in faces]
+    all_candidate_faces = [face for faces in candidate_faces.values() for face in faces]
+    if not all_target_faces or not (index or all_candidate_faces):
+        return False
+
+    # Find similar faces
+
+    if index:
+
+        # One find_similar call per target face searches the whole indexed face list
+
+        found = azface_search_index(client, all_target_faces, index, top=top, workers=workers)
+
+        for target_url in target_urls:
+            if writer is not None:
+                writer.write_all(get_index_records(target_faces[target_url], found, target_url))
+            else:
+                print_index_results(target_faces[target_url], found, tag=target_url if tagged else None, file=file)
+
+    else:
+
+        # One find_similar call per target face covers the candidate faces of all photos
+
+        similar = azface_find_similar(client, all_target_faces, all_candidate_faces, workers=workers)
+
+        for target_url in target_urls:
+            for candidate_url in candidate_urls:
+                matches = match_similar(
+                    target_faces[target_url], candidate_faces[candidate_url], similar, threshold=threshold)
+                if writer is not None:
+                    writer.write_all(get_similar_records(
+                        target_faces[target_url], candidate_faces[candidate_url], matches, target_url, candidate_url))
+                else:
+                    print_similar_results(
+                        target_faces[target_url],
+                        candidate_faces[candidate_url],
+                        matches,
+                        tag="{},{}".format(target_url, candidate_url) if tagged else None,
+                        file=file)
+
+                if renderer is not None and matches:
+                    target_marks, candidate_marks = get_similar_marks(
+                        target_faces[target_url], candidate_faces[candidate_url], matches)
+                    renderer.submit(
+                        [(target_url, target_marks), (candidate_url, candidate_marks)], target_url, candidate_url)
+
+    return True